@@ -14,27 +14,378 @@
 
 from __future__ import with_statement
 
-import os, re, sys, hashlib
-from itertools import groupby, imap
+import os, re, sys, hashlib, math
+from itertools import chain, groupby, imap, izip
 from operator import itemgetter
 from optparse import OptionParser, OptionGroup
 
 # for the xml parsing
-import xml.etree.ElementTree as ET
+try:
+  import xml.etree.cElementTree as ET
+except ImportError:
+  import xml.etree.ElementTree as ET
 from operator import itemgetter
 
 # for files listing
 import glob
 
+# for the parsed sessions cache
+from array import array
+from bisect import bisect_left, bisect_right
+
 import sys
 import logging
 
+# the seconds of samples in each row group (record batch) of the
+# exported sessions
+export_window = 60
+
+# for the machine-readable output formats
+import json
+from collections import OrderedDict
+
+# for the query server
+import BaseHTTPServer, urlparse
+from StringIO import StringIO
+
+# for the timings of the phases of a run
+import time
+from contextlib import contextmanager
+
+# optional: used by the vectorized aggregation engine
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# for reading the logs straight from tar and zip archives
+import tarfile, zipfile, zlib, bz2, errno
+import threading, Queue
+from multiprocessing.pool import ThreadPool
+
+# optional: used for the zstd compressed archives
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
 # some macros
 float_template = "%8.4f"
 int_template = "%d"
 
+# the parsed sessions cache, stored next to packages.xml
+cache_filename = ".asa-cache"
+cache_version = 6
+# the first line of the cache files
+cache_magic = "appscope-analyzer cache\n"
+# the window sizes (in seconds) of the samples summed up in the cache,
+# each one a multiple of the previous one
+pyramid_levels = [60, 300, 3600]
+# the units of the window sizes (--bucket)
+bucket_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+# the (UID, package name) pairs of packages.xml, stored next to it
+packages_cache_filename = ".asa-packages"
+# the archives that can be read in place of a source directory
+archive_extensions = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+                      '.tar.zst', '.tzst', '.zip')
+# the bytes of an archive decompressed at a time, and the decompressed
+# chunks kept ahead of the reader
+archive_chunk_size = 1 << 20
+archive_queue_size = 16
+# the files read from an archive: the logs of the seconds (with the
+# directory of the second, the kind of log and the second) and
+# packages.xml
+_archive_member_re = re.compile(r'(?:^|/)(?:(\d+)/(raw|power)/(\d+)(?:\.log)?|packages\.xml)$')
+
+# the number of CPU frequencies the ticks are counted for, and the
+# number of fields of the usage (raw) and of the power log lines
+cpu_frequencies = 12
+raw_fields = 3 + cpu_frequencies + 7
+power_fields = 5
+# the characters of the fields of the log lines
+raw_chars = '0123456789 -'
+power_chars = '0123456789 -.'
+# the malformed lines shown at the end of a run
+parse_error_examples = 5
+
+# the relative error of the power percentiles of the summaries
+summary_precision = 0.01
+
+# the seconds between two looks for new log files, when following
+# a recording session, and the idle looks before the source directory
+# is listed again (to skip over missing seconds)
+follow_interval = 1.0
+follow_rescan = 10
+
+# array typecodes of the stats columns in the cache
+# (cpu_ticks is stored flattened, one row after the other)
+cache_typecodes = {'time':'l', 'pid':'l', 'tgid':'l', 'uid':'l',
+                   'cpu_ticks':'l', 'disp':'l', 'gps':'l',
+                   'wifi_snd_pkts':'l', 'wifi_rcv_pkts':'l',
+                   '3g_low':'l', '3g_high':'l', 'calling':'l',
+                   'cpu_en':'d', 'display_en':'d', 'gps_en':'d',
+                   'wifi_en':'d', '3g_en':'d', 'total_en':'d'}
+
 # Utilities funtions
 
+class Timings:
+  """
+    Timings (class)
+
+    Collects the time spent in each phase of a run (listing, reading
+    and parsing the logs, combining, printing...) and a few counters
+    (files opened, bytes read, lines parsed, rows kept), reported with
+    the --timings option
+  """
+
+  def __init__(self):
+    self.start = time.time()
+    self.phases = dict()
+    self.counters = dict()
+    # the phases and counters in the order they were first used
+    self.order = list()
+
+  @contextmanager
+  def phase(self, name):
+    """
+      phase(name)
+
+      context manager adding the time spent in its block to the
+      given phase
+    """
+    start = time.time()
+    try:
+      yield
+    finally:
+      if name not in self.phases:
+        self.phases[name] = 0.0
+        self.order.append(name)
+      self.phases[name] += time.time() - start
+
+  def count(self, name, n=1):
+    if name not in self.counters:
+      self.counters[name] = 0
+      self.order.append(name)
+    self.counters[name] += n
+
+  def clear_counters(self):
+    self.order = [name for name in self.order if name not in self.counters]
+    self.counters = dict()
+
+  def counter_state(self):
+    return [(name, self.counters[name]) for name in self.order
+            if name in self.counters]
+
+  def merge_counters(self, state):
+    """
+      merge_counters(state)
+
+      add the counters of another Timings (its counter_state(), e.g.
+      from a worker process)
+    """
+    for name, n in state:
+      self.count(name, n)
+
+  def report(self, out=None):
+    """
+      report(out)
+
+      print the timings of the phases and the counters (to the
+      standard error by default)
+    """
+    out = out or sys.stderr
+    width = max([len(name) for name in self.order] + [len('total')])
+    out.write('\n')
+    for name in self.order:
+      if name in self.phases:
+        out.write('%-*s  %10.4f s\n' % (width, name, self.phases[name]))
+    out.write('%-*s  %10.4f s\n' % (width, 'total', time.time() - self.start))
+    for name in self.order:
+      if name in self.counters:
+        out.write('%-*s  %10d\n' % (width, name, self.counters[name]))
+
+# the timings of the current run
+timings = Timings()
+
+
+class ParseErrors:
+  """
+    ParseErrors (class)
+
+    Counts the malformed log lines skipped while parsing (e.g. the
+    truncated lines of a device that rebooted), by reason, and keeps
+    the first few of them, reported at the end of a run
+  """
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.counts = dict()
+    # the reasons in the order they were first seen
+    self.order = list()
+    # (second, log, line number, line, reason) tuples
+    self.examples = list()
+
+  def add(self, reason, second, log, number, line, n=1):
+    """
+      add(reason, second, log, number, line, n)
+
+      arguments:
+      reason         -- why the line was skipped
+      second         -- the second of the log file
+      log            -- the log file ('raw' or 'power')
+      number         -- the number of the line in the log file
+      line           -- the line (None if there is no such line)
+      n              -- the number of lines skipped for this reason
+    """
+    if reason not in self.counts:
+      self.counts[reason] = 0
+      self.order.append(reason)
+    self.counts[reason] += n
+    if len(self.examples) < parse_error_examples:
+      self.examples.append( (second, log, number, line, reason) )
+
+  def state(self):
+    return self.counts, self.order, self.examples
+
+  def merge(self, state):
+    """
+      merge(state)
+
+      add the counts and the examples of another ParseErrors (its
+      state(), e.g. from a worker process)
+    """
+    counts, order, examples = state
+    for reason in order:
+      if reason not in self.counts:
+        self.counts[reason] = 0
+        self.order.append(reason)
+      self.counts[reason] += counts[reason]
+    self.examples.extend(examples[:parse_error_examples - len(self.examples)])
+
+  def report(self, out=None):
+    """
+      report(out)
+
+      print the number of malformed lines skipped for each reason and
+      the first few of them (to the standard error by default), if any
+    """
+    if not self.counts:
+      return
+    out = out or sys.stderr
+    width = max(len(reason) for reason in self.order)
+    out.write('\nwarning: malformed log lines were skipped:\n')
+    for reason in self.order:
+      out.write('  %-*s  %8d\n' % (width, reason, self.counts[reason]))
+    for second, log, number, line, reason in self.examples:
+      path = '%s/%s/%s' % (second, log, second)
+      if log == 'power':
+        path += '.log'
+      out.write('  %s line %d: %s' % (path, number, reason))
+      if line is not None:
+        out.write(': %r' % line[:80])
+      out.write('\n')
+
+# the malformed lines of the current run
+parse_errors = ParseErrors()
+
+
+class Summary:
+  """
+    Summary (class)
+
+    Streaming accumulator of the energy of an app (or process). The
+    samples are added in time order and summed per second; only the
+    totals of each component, the number of seconds, the peak power
+    and a histogram of the power with logarithmic buckets are kept,
+    so the memory used does not grow with the length of the session
+  """
+
+  # the ratio of the bounds of each bucket of the histogram
+  base = math.log(1 + 2 * summary_precision)
+
+  def __init__(self):
+    self.totals = [0.0] * len(power_keys)
+    self.seconds = 0
+    self.peak = 0.0
+    # bucket -> number of seconds (None for the seconds without power)
+    self.histogram = dict()
+    # the second being summed up and its totals
+    self._second = None
+    self._energies = None
+
+  def add(self, second, energies):
+    """
+      add(second, energies)
+
+      arguments:
+      second         -- the time of the sample
+      energies       -- the energy of each component (see power_keys)
+
+    """
+    if second != self._second:
+      self.close()
+      self._second = second
+      self._energies = list(energies)
+    else:
+      for i, energy in enumerate(energies):
+        self._energies[i] += energy
+
+  def close(self):
+    """
+      close
+
+      add the second being summed up to the summary
+
+    """
+    if self._second is None:
+      return
+    for i, energy in enumerate(self._energies):
+      self.totals[i] += energy
+    self.seconds += 1
+    # the energy of a second is the mean power in it
+    power = self._energies[-1]
+    self.peak = max(self.peak, power)
+    if power > 0:
+      bucket = int(math.floor(math.log(power) / self.base))
+    else:
+      bucket = None
+    self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+    self._second = None
+
+  def mean(self):
+    self.close()
+    if not self.seconds:
+      return 0.0
+    return self.totals[-1] / self.seconds
+
+  def percentile(self, q):
+    """
+      percentile(q)
+
+      arguments:
+      q              -- the percentile (0-100)
+
+      returns the power that q% of the seconds do not exceed, within
+      the precision of the histogram
+
+    """
+    self.close()
+    if not self.seconds:
+      return 0.0
+    rank = max(1, int(math.ceil(q / 100.0 * self.seconds)))
+    count = self.histogram.get(None, 0)
+    if count >= rank:
+      return 0.0
+    for bucket in sorted(b for b in self.histogram if b is not None):
+      count += self.histogram[bucket]
+      if count >= rank:
+        # the middle of the bucket, in logarithmic scale
+        return min(math.exp((bucket + 0.5) * self.base), self.peak)
+    return self.peak
+
+
 def _bold(msg):
   """
     _bold(msg)
@@ -65,88 +416,2148 @@ def _sum(seq):
     return sum(seq)
 
 
-def _combine_duplicate_time_samples (samples, key='time'):
-  """
-    _combine_duplicate_time_samples (samples)
+def _combine_duplicate_time_samples (samples, key='time'):
+  """
+    _combine_duplicate_time_samples (samples)
+
+    arguments:
+    samples              -- a dictionary with the sample lists
+    key                  -- the key list to be used for the comparison
+
+    sum up n same sized lists based contained in a dictionary
+    based on identical elements of the one given by a dictionary
+    key
+
+  """
+  # required modules:
+  # from itertools import groupby
+  # from operator import itemgetter
+
+  # construct a list with all the key names (starting from 'time')
+  keys = ['time'] + [key for key in samples.keys() if key!='time']
+  # construct a list with all the keys' lists (starting from the one of 'time')
+  keys_lists = [ samples['time'] ] + [samples[key] for key in samples.keys() if key!='time']
+  groups = groupby(zip(*keys_lists), key=itemgetter(0))
+  lists = zip(*[[k] + map(_sum, zip(*g)[1:]) for k, g in groups])
+  new_d = dict(zip((keys), lists))
+  return new_d
+
+
+
+def _combine_duplicate_time_samples_numpy (samples):
+  """
+    _combine_duplicate_time_samples_numpy (samples)
+
+    arguments:
+    samples              -- a dictionary with the sample lists
+
+    same as _combine_duplicate_time_samples, but the samples are
+    summed up per time with NumPy: the integer columns (and the cpu
+    ticks, as a 2-D array of frequency buckets) with add.reduceat and
+    the power columns with bincount, which adds the values in order
+    exactly like the built-in sum does, so the results are identical.
+    The columns that are arrays (see _unpack_stats) are used in place,
+    without being converted
+
+  """
+  def column(l, dtype):
+    if isinstance(l, array):
+      return numpy.frombuffer(l, dtype=l.typecode)
+    return numpy.asarray(l, dtype=dtype)
+
+  def ticks(l):
+    # the cpu ticks of each sample, as the rows of a 2-D array
+    width = len(l[0])
+    return numpy.fromiter(chain.from_iterable(l), numpy.int64,
+                          len(l) * width).reshape(len(l), width)
+
+  time = column(samples['time'], numpy.int64)
+  if not len(time) or len(set(map(len, samples.get('cpu_ticks', [()])))) > 1:
+    # nothing to combine or ragged cpu ticks: use the pure Python path
+    return _combine_duplicate_time_samples(samples)
+  # the first sample of each group of samples with the same time
+  first = numpy.empty(len(time), dtype=bool)
+  first[0] = True
+  numpy.not_equal(time[1:], time[:-1], out=first[1:])
+  starts = numpy.flatnonzero(first)
+  groups = numpy.cumsum(first) - 1
+
+  new_d = {'time': tuple(time[starts].tolist())}
+  for key, l in samples.iteritems():
+    if key == 'time':
+      continue
+    elif key in power_keys:
+      sums = numpy.bincount(groups, weights=column(l, numpy.float64))
+    elif key == 'cpu_ticks':
+      sums = numpy.add.reduceat(ticks(l), starts, axis=0)
+    else:
+      sums = numpy.add.reduceat(column(l, numpy.int64), starts, axis=0)
+    new_d[key] = tuple(sums.tolist())
+  return new_d
+
+
+def _iter_combined_samples (samples):
+  """
+    _iter_combined_samples (samples)
+
+    arguments:
+    samples              -- an iterable of sample tuples (see stats_keys)
+                            sorted by time
+
+    generator that sums up the consecutive samples with the same
+    time, yielding one combined sample (a list) per second
+
+  """
+  for k, g in groupby(samples, key=itemgetter(0)):
+    yield [k] + map(_sum, zip(*g)[1:])
+
+
+def _new_stats_dict():
+  """
+    _new_stats_dict function
+
+    creates a new stats dictionary containing 6 lists with
+    the following keys: time, cpu, display, gps, wifi, 3g
+  """
+  return {'time':[],
+          'cpu':[],
+          'display':[],
+          'gps':[],
+          'wifi':[],
+          '3g':[]
+         }
+
+def _new_stats_dict():
+  """
+    _new_stats_dict function
+
+    creates a new stats dictionary containing 18 lists with
+    the following keys: vtime, pid, tgid, uid, cpu_ticks, disp,
+    gps, wifi_snd_pkts, wifi_rcv_pkts, 3g_low, 3g_high, calling,
+    cpu_en, display_en, gps_en, wifi_en, 3g_en, total_en
+
+  """
+  return {'time':[],
+          'pid':[],
+          'tgid':[],
+          'uid':[],
+          'cpu_ticks':[],
+          'disp':[],
+          'gps':[],
+          'wifi_snd_pkts':[],
+          'wifi_rcv_pkts':[],
+          '3g_low':[],
+          '3g_high':[],
+          'calling':[],
+          'cpu_en':[],
+          'display_en':[],
+          'gps_en':[],
+          'wifi_en':[],
+          '3g_en':[],
+          'total_en':[]
+         }
+
+# the keys of the stats dictionary in the order of the sample tuples
+stats_keys = ['time', 'pid', 'tgid', 'uid', 'cpu_ticks', 'disp', 'gps',
+              'wifi_snd_pkts', 'wifi_rcv_pkts', '3g_low', '3g_high',
+              'calling', 'cpu_en', 'display_en', 'gps_en', 'wifi_en',
+              '3g_en', 'total_en']
+
+# the output columns of each output mode as (stats key, title) tuples
+output_columns = {
+  'default': [('time', 'TIME'), ('cpu_en', 'CPU'), ('display_en', 'DISPLAY'),
+              ('gps_en', 'GPS'), ('wifi_en', 'WIFI'), ('3g_en', '3G'),
+              ('total_en', 'TOTAL')],
+  'quiet': [('time', 'TIME'), ('total_en', 'TOTAL POWER CONSUMPTION')],
+  'verbose': [('time', 'TIME'), ('cpu_ticks', 'CPU TICKS'),
+              ('disp', 'DISPLAY (US)'), ('gps', 'GPS (US)'),
+              ('wifi_snd_pkts', 'WIFI SND PKTS'),
+              ('wifi_rcv_pkts', 'WIFI RCV PKTS'), ('3g_low', '3G LOW'),
+              ('3g_high', '3G HIGH'), ('calling', 'CALLING'),
+              ('cpu_en', 'CPU'), ('display_en', 'DISPLAY'), ('gps_en', 'GPS'),
+              ('wifi_en', 'WIFI'), ('3g_en', '3G'), ('total_en', 'TOTAL')],
+  'usage': [('time', 'TIME'), ('cpu_ticks', 'CPU TICKS'),
+            ('disp', 'DISPLAY (US)'), ('gps', 'GPS (US)'),
+            ('wifi_snd_pkts', 'WIFI SND PKTS'),
+            ('wifi_rcv_pkts', 'WIFI RCV PKTS'), ('3g_low', '3G LOW'),
+            ('3g_high', '3G HIGH'), ('calling', 'CALLING')],
+}
+
+# the power (floating point) stats keys
+power_keys = ['cpu_en', 'display_en', 'gps_en', 'wifi_en', '3g_en', 'total_en']
+
+# the usage (integer) stats keys that follow the cpu ticks
+usage_keys = ['disp', 'gps', 'wifi_snd_pkts', 'wifi_rcv_pkts', '3g_low',
+              '3g_high', 'calling']
+
+# the stats keys that are always parsed (needed by the indexes)
+index_keys = ['time', 'pid', 'tgid', 'uid']
+
+# the components that can be selected and their power and usage stats keys
+component_keys = OrderedDict([('cpu', ['cpu_en', 'cpu_ticks']),
+                              ('display', ['display_en', 'disp']),
+                              ('gps', ['gps_en', 'gps']),
+                              ('wifi', ['wifi_en', 'wifi_snd_pkts', 'wifi_rcv_pkts']),
+                              ('3g', ['3g_en', '3g_low', '3g_high', 'calling']),
+                              ('total', ['total_en'])])
+
+# the column widths used when the output is streamed (no pre-scan
+# of the values is possible, so wider values just shift the line)
+stream_widths = {'time': 6, 'cpu_ticks': 40, 'power': 10, 'usage': 8}
+
+def _format_value (key, value):
+  """
+    _format_value (key, value)
+
+    arguments:
+    key                  -- the stats key of the value
+    value                -- the value to be formatted
+
+    returns the value formatted as it is printed in the output
+
+  """
+  if key == 'cpu_ticks':
+    return '|%s|' % ' '.join(map(str, value))
+  elif key in power_keys:
+    return float_template % value
+  else:
+    return int_template % value
+
+# the output formats
+output_formats = ['text', 'csv', 'tsv', 'jsonl']
+
+# the number of output lines written at once
+output_batch = 1024
+
+def _format_field (value, separator):
+  """
+    _format_field (value, separator)
+
+    arguments:
+    value                -- the value to be formatted
+    separator            -- the field separator of the output format
+
+    returns the value formatted as a CSV or TSV field (the cpu ticks
+    are separated by spaces, fields containing the separator are quoted)
+
+  """
+  if isinstance(value, (list, tuple)):
+    return ' '.join(map(str, value))
+  elif isinstance(value, float):
+    return "%.4f" % value
+  elif isinstance(value, basestring):
+    if separator in value or '"' in value:
+      return '"%s"' % value.replace('"', '""')
+    return value
+  else:
+    return int_template % value
+
+def _format_record (keys, values, format):
+  """
+    _format_record (keys, values, format)
+
+    arguments:
+    keys                 -- the names of the fields
+    values               -- the values of the fields
+    format               -- one of the machine-readable output formats
+
+    returns the record formatted as a line of the given format
+
+  """
+  if format == 'jsonl':
+    values = [round(value, 4) if isinstance(value, float) else value
+              for value in values]
+    return json.dumps(OrderedDict(zip(keys, values)), separators=(',', ':'))
+  separator = format == 'csv' and ',' or '\t'
+  return separator.join(_format_field(value, separator) for value in values)
+
+def _stream_width (key, title):
+  if key in ('time', 'cpu_ticks'):
+    width = stream_widths[key]
+  elif key in power_keys:
+    width = stream_widths['power']
+  else:
+    width = stream_widths['usage']
+  return max(width, len(title))
+
+
+def _parse_bucket (spec):
+  """
+    _parse_bucket (spec)
+
+    arguments:
+    spec                 -- a window size, e.g. '90', '60s', '5m' or '1h'
+
+    returns the window size in seconds. raises ValueError if the
+    size is not a positive number of seconds, minutes, hours or days
+
+  """
+  unit = 1
+  if spec[-1:] in bucket_units:
+    spec, unit = spec[:-1], bucket_units[spec[-1]]
+  size = int(spec) * unit
+  if size <= 0:
+    raise ValueError(spec)
+  return size
+
+def _bucket_stats (stats, size, per_process=False):
+  """
+    _bucket_stats (stats, size, per_process=False)
+
+    arguments:
+    stats                -- a stats dictionary sorted by time
+    size                 -- the window size in seconds
+    per_process          -- keep the samples of each process apart
+
+    returns a stats dictionary with the samples summed up in windows
+    of size seconds (per process, if asked), the time of each being
+    the first second of its window. The energy and the usage counters
+    are summed up, the PID, TGID and UID of the processes are kept (a
+    PID reused by another process makes another row)
+
+  """
+  times = stats['time']
+  if per_process:
+    processes = izip(stats['uid'], stats['tgid'], stats['pid'])
+  else:
+    processes = [None] * len(times)
+  # (window, (UID, TGID, PID)) -> its index and the index of each sample
+  groups = dict()
+  order = list()
+  group_of = list()
+  for time, process in izip(times, processes):
+    key = (time - time % size, process)
+    group = groups.get(key)
+    if group is None:
+      group = groups[key] = len(order)
+      order.append(key)
+    group_of.append(group)
+
+  new_d = dict()
+  for key, column in stats.iteritems():
+    if key == 'time':
+      new_d[key] = [window for window, process in order]
+    elif key == 'cpu_ticks':
+      sums = [None] * len(order)
+      for group, ticks in izip(group_of, column):
+        if sums[group] is None:
+          sums[group] = list(ticks)
+        else:
+          sums[group] = [a + b for a, b in zip(sums[group], ticks)]
+      new_d[key] = sums
+    elif key in index_keys:
+      # the same for all the samples of a process
+      values = [0] * len(order)
+      for group, value in izip(group_of, column):
+        values[group] = value
+      new_d[key] = values
+    else:
+      sums = [0] * len(order)
+      for group, value in izip(group_of, column):
+        sums[group] += value
+      new_d[key] = sums
+  return new_d
+
+def _select_columns (columns, components):
+  """
+    _select_columns (columns, components)
+
+    arguments:
+    columns              -- a list of (stats key, title) tuples
+    components           -- a list of component names (see component_keys)
+
+    returns the time column and the columns of the given components,
+    or all the columns if no components are given
+
+  """
+  if not components:
+    return columns
+  keys = set(key for component in components for key in component_keys[component])
+  return [(key, title) for key, title in columns if key == 'time' or key in keys]
+
+def _is_archive (path):
+  """
+    _is_archive (path)
+
+    arguments:
+    path                 -- the path of a source directory or archive
+
+    returns True if the given path is an archive file (see
+    archive_extensions) and not a directory
+
+  """
+  return path.endswith(archive_extensions) and os.path.isfile(path)
+
+class _DecompressedStream:
+  """
+    _DecompressedStream (class)
+
+    A read-only file object over the decompressed contents of a file,
+    the decompression being done on a worker thread (zlib, bz2 and
+    zstandard release the GIL) while the reader consumes the chunks
+    already decompressed
+
+  """
+  def __init__(self, f, decompressor):
+    self.chunks = Queue.Queue(archive_queue_size)
+    self.buffer = ''
+    self.offset = 0
+    self.eof = False
+    self.stopped = False
+    self.thread = threading.Thread(target=self._decompress,
+                                   args=(f, decompressor))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _decompress(self, f, decompressor):
+    try:
+      while not self.stopped:
+        chunk = f.read(archive_chunk_size)
+        if not chunk:
+          break
+        data = decompressor.decompress(chunk)
+        if data:
+          self.chunks.put(data)
+      if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+          self.chunks.put(data)
+    except Exception, e:
+      self.chunks.put(e)
+    self.chunks.put(None)
+
+  def close(self):
+    # stop the worker thread (before the file is closed), skipping the
+    # chunks it already decompressed
+    self.stopped = True
+    while not self.eof:
+      chunk = self.chunks.get()
+      if chunk is None or isinstance(chunk, Exception):
+        self.eof = True
+    self.thread.join()
+
+  def read(self, size=-1):
+    # the chunks are sliced at an offset, so that the many small reads
+    # of tarfile do not copy the rest of the chunk each time
+    available = len(self.buffer) - self.offset
+    if 0 <= size <= available:
+      data = self.buffer[self.offset:self.offset + size]
+      self.offset += size
+      return data
+    pieces = [self.buffer[self.offset:]]
+    length = available
+    while not self.eof and (size < 0 or length < size):
+      chunk = self.chunks.get()
+      if chunk is None:
+        self.eof = True
+      elif isinstance(chunk, Exception):
+        self.eof = True
+        raise IOError("cannot decompress the archive: %s" % chunk)
+      else:
+        pieces.append(chunk)
+        length += len(chunk)
+    self.buffer = ''.join(pieces)
+    self.offset = 0
+    if size < 0 or length <= size:
+      data, self.buffer = self.buffer, ''
+      return data
+    self.offset = size
+    return self.buffer[:size]
+
+def _decompressor (path, magic):
+  """
+    _decompressor (path, magic)
+
+    arguments:
+    path                 -- the path of a tar archive
+    magic                -- the first bytes of the archive
+
+    returns a decompressor object for the compression of the archive
+    (told by its magic number), or None if it is not compressed.
+    raises IOError if it is compressed with zstd and zstandard is not
+    installed
+
+  """
+  if magic.startswith('\x1f\x8b'):
+    # gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  if magic.startswith('BZh'):
+    return bz2.BZ2Decompressor()
+  if magic.startswith('\x28\xb5\x2f\xfd'):
+    if not zstandard:
+      raise IOError("reading %s requires zstandard to be installed" % path)
+    return zstandard.ZstdDecompressor().decompressobj()
+  return None
+
+class Archive:
+  """
+    Archive (class)
+
+    The AppScope logs of a tar (optionally gzip, bzip2 or zstd
+    compressed) or zip archive, read in a single pass without being
+    extracted. Only the log files and packages.xml are kept (in
+    memory), by their paths relative to the directory of packages.xml
+
+  """
+  def __init__(self, path, threads=None):
+    """
+      __init__(path, threads)
+
+      arguments:
+      path                 -- the path of the archive
+      threads              -- the number of threads decompressing the
+                              members of a zip archive (default: the
+                              number of CPUs)
+
+      raises IOError if the archive cannot be read
+
+    """
+    self.path = path
+    # relative path -> (mtime, contents)
+    self.members = dict()
+    with timings.phase('archive'):
+      try:
+        if zipfile.is_zipfile(path):
+          members = self._read_zip(threads)
+        else:
+          members = self._read_tar()
+      except (tarfile.TarError, zipfile.BadZipfile, zlib.error, EOFError,
+              NotImplementedError), e:
+        raise IOError("cannot read the archive %s: %s" % (path, e))
+    # the logs may be stored under a top-level directory
+    prefixes = [name[:-len('packages.xml')] for name in members
+                if name.rsplit('/', 1)[-1] == 'packages.xml']
+    prefix = min(prefixes, key=len) if prefixes else ''
+    for name, member in members.iteritems():
+      if name.startswith(prefix):
+        self.members[name[len(prefix):]] = member
+    timings.count('archive members', len(self.members))
+
+  def _read_tar(self):
+    # the members are read in the order they are stored, while the
+    # worker thread decompresses the ones that follow
+    members = dict()
+    with open(self.path, 'rb') as f:
+      decompressor = _decompressor(self.path, f.read(4))
+      f.seek(0)
+      fileobj = f
+      if decompressor:
+        fileobj = _DecompressedStream(f, decompressor)
+      try:
+        tar = tarfile.open(fileobj=fileobj, mode='r|')
+        for info in tar:
+          name = info.name
+          while name.startswith('./'):
+            name = name[2:]
+          if info.isfile() and _archive_member_re.search(name):
+            members[name] = (info.mtime, tar.extractfile(info).read())
+        tar.close()
+      finally:
+        if fileobj is not f:
+          fileobj.close()
+    return members
+
+  def _read_zip(self, threads):
+    # the members are compressed one by one, and inflated by a pool of
+    # threads, each reading them through its own ZipFile (a ZipFile is
+    # not safe to share between threads)
+    zf = zipfile.ZipFile(self.path)
+    infos = [info for info in zf.infolist()
+             if _archive_member_re.search(info.filename)]
+    zf.close()
+    local = threading.local()
+    opened = list()
+    def read(info):
+      if not hasattr(local, 'zf'):
+        local.zf = zipfile.ZipFile(self.path)
+        opened.append(local.zf)
+      return local.zf.read(info)
+    pool = ThreadPool(threads)
+    try:
+      contents = pool.map(read, infos)
+    finally:
+      pool.close()
+      pool.join()
+      for zf in opened:
+        zf.close()
+    return dict((info.filename, (time.mktime(info.date_time + (0, 0, -1)), data))
+                for info, data in izip(infos, contents))
+
+  def list_seconds(self, first=None, last=None):
+    """
+      list_seconds(first, last)
+
+      same as _list_seconds, for the logs of the archive. The paths of
+      the logs are the path of the archive followed by their paths in it
+
+    """
+    seconds = list()
+    power_dict = dict()
+    for name in self.members:
+      m = _archive_member_re.match(name)
+      if not m or m.group(1) is None:
+        continue
+      second = int(m.group(1))
+      if (first is not None and second < first) or \
+         (last is not None and second > last):
+        continue
+      fn = '%s/%s' % (self.path, name)
+      if m.group(2) == 'raw':
+        seconds.append( (int(m.group(3)), fn) )
+      else:
+        power_dict[int(m.group(3))] = fn
+    seconds.sort()
+    return [(second, raw_fn, power_dict.get(second))
+            for second, raw_fn in seconds]
+
+  def member(self, name):
+    """
+      member(name)
+
+      arguments:
+      name                 -- the path of a file in the archive
+
+      returns the (mtime, contents) of the given file. raises OSError
+      if the archive has no such file
+
+    """
+    try:
+      return self.members[name]
+    except KeyError:
+      raise OSError(errno.ENOENT, os.strerror(errno.ENOENT),
+                    '%s/%s' % (self.path, name))
+
+# archive path -> its Archive, each archive being read once per run
+_archives = dict()
+
+def _open_archive (path):
+  """
+    _open_archive (path)
+
+    arguments:
+    path                 -- the path of a source directory or archive
+
+    returns the Archive of the given path (reading it on first use),
+    or None if it is a directory
+
+  """
+  archive = _archives.get(path)
+  if archive is None and _is_archive(path):
+    archive = _archives[path] = Archive(path)
+  return archive
+
+def _archive_file (fn):
+  """
+    _archive_file (fn)
+
+    arguments:
+    fn                   -- the path of a file
+
+    returns the (Archive, name) of a file in an archive that was
+    already read, or (None, None) for a file in a directory
+
+  """
+  for path, archive in _archives.iteritems():
+    if fn.startswith(path) and fn[len(path):len(path) + 1] == '/':
+      return archive, fn[len(path) + 1:]
+  return None, None
+
+def _cache_file (sourcedir, filename):
+  """
+    _cache_file (sourcedir, filename)
+
+    arguments:
+    sourcedir            -- the path of a source directory or archive
+    filename             -- the name of a cache file
+
+    returns the path of the given cache file: in the source directory,
+    or next to the archive (its name followed by the cache filename)
+
+  """
+  if _is_archive(sourcedir):
+    return sourcedir + filename
+  return os.path.join(sourcedir, filename)
+
+def _list_seconds (sourcedir, first=None, last=None):
+  """
+    _list_seconds (sourcedir, first, last)
+
+    arguments:
+    sourcedir            -- the directory containing the AppScope logs
+    first                -- skip the seconds before this one (if given)
+    last                 -- skip the seconds after this one (if given)
+
+    returns a list of (second, raw_fn, power_fn) tuples sorted by
+    second. power_fn is None when a second has no power log. The
+    seconds are selected from the names of their directories, so the
+    directories out of the time range are never looked into. If
+    sourcedir is an archive, the seconds are listed from its files
+
+  """
+  archive = _open_archive(sourcedir)
+  if archive:
+    return archive.list_seconds(first, last)
+  try:
+    names = os.listdir(sourcedir)
+  except OSError:
+    return []
+  dirs = list()
+  for name in names:
+    if not name.isdigit():
+      continue
+    second = int(name)
+    if (first is not None and second < first) or \
+       (last is not None and second > last):
+      continue
+    dirs.append(name)
+  seconds = list()
+  power_dict = dict()
+  for name in dirs:
+    raw_fns, power_fns = _list_dir(sourcedir, name)
+    seconds.extend(raw_fns)
+    power_dict.update(power_fns)
+  seconds.sort()
+  return [(second, raw_fn, power_dict.get(second))
+          for second, raw_fn in seconds]
+
+
+def _list_dir (sourcedir, name):
+  """
+    _list_dir (sourcedir, name)
+
+    arguments:
+    sourcedir            -- the directory containing the AppScope logs
+    name                 -- the name of the directory of a second
+
+    returns a list of the (second, raw_fn) tuples and a dictionary of
+    the power logs (second -> power_fn) found in the given directory
+
+  """
+  raw_fns = [(int(fn.rsplit('/', 1)[1]), fn)
+             for fn in glob.glob('%s/%s/raw/[0-9]*' % (sourcedir, name))]
+  power_fns = dict((int(fn.rsplit('/', 1)[1].split('.log')[0]), fn)
+                   for fn in glob.glob('%s/%s/power/[0-9]*.log' % (sourcedir, name)))
+  return raw_fns, power_fns
+
+
+def _file_signature (fn):
+  """
+    _file_signature (fn)
+
+    arguments:
+    fn                   -- the path of a file (or None)
+
+    returns a (mtime, size) tuple used to detect changes of a
+    log file, or None if no file is given
+
+  """
+  if fn is None:
+    return None
+  archive, name = _archive_file(fn)
+  if archive:
+    mtime, data = archive.member(name)
+    return (mtime, len(data))
+  st = os.stat(fn)
+  return (st.st_mtime, st.st_size)
+
+
+def _iterparse_packages (pxml_path):
+  """
+    _iterparse_packages (pxml_path)
+
+    arguments:
+    pxml_path            -- the path of a packages.xml file
+
+    returns a list of (UID, package name) tuples of the packages and a
+    list of (UID, name) tuples of the shared users found in the given
+    file. the file is parsed incrementally, keeping only the attributes
+    needed and dropping every top-level element (and its permissions)
+    as soon as it is read
+
+  """
+  app_list = []
+  shared_users = []
+  depth = 0
+  root = None
+  source = pxml_path
+  archive, name = _archive_file(pxml_path)
+  if archive:
+    source = StringIO(archive.member(name)[1])
+  for event, elem in ET.iterparse(source, events=('start', 'end')):
+    if event == 'start':
+      if root is None:
+        root = elem
+      depth += 1
+      continue
+    depth -= 1
+    if depth != 1:
+      continue
+    if elem.tag == 'package':
+      uid = elem.get('userId')
+      if not uid:
+        uid = elem.get('sharedUserId')
+      app_list.append( (uid, elem.get('name')) )
+    elif elem.tag == 'shared-user':
+      shared_users.append( (elem.get('userId'), elem.get('name')) )
+    root.clear()
+  return app_list, shared_users
+
+
+# source directory -> (signature of packages.xml, (UID, package name)
+# list, (UID, shared user name) list)
+_packages_memo = dict()
+
+def _read_packages (sourcedir, use_cache=True):
+  """
+    _read_packages (sourcedir, use_cache=True)
+
+    arguments:
+    sourcedir            -- the directory containing the packages.xml file
+    use_cache            -- read and write the packages cache in sourcedir
+
+    returns the (UID, package name) tuples of the packages.xml file of
+    the given directory, parsing it only once per run and, if the cache
+    is used, only when it changed since the last run. raises IOError if
+    there is no packages.xml file
+
+  """
+  return _load_packages(sourcedir, use_cache)[0]
+
+def _read_shared_users (sourcedir, use_cache=True):
+  """
+    _read_shared_users (sourcedir, use_cache=True)
+
+    same as _read_packages, but returns the (UID, shared user name)
+    tuples of the shared users of the packages.xml file
+
+  """
+  return _load_packages(sourcedir, use_cache)[1]
+
+def _load_packages (sourcedir, use_cache=True):
+  # the (memoized) packages and shared users of packages.xml
+  pxml_path = os.path.join(sourcedir, "packages.xml")
+  try:
+    if _is_archive(sourcedir):
+      # an archive changes as a whole, and is only read if it did
+      signature = _file_signature(sourcedir)
+    else:
+      signature = _file_signature(pxml_path)
+  except OSError, e:
+    raise IOError(e.errno, e.strerror, pxml_path)
+  memo = _packages_memo.get(sourcedir)
+  if memo and memo[0] == signature:
+    return memo[1:]
+
+  cache_path = _cache_file(sourcedir, packages_cache_filename)
+  app_list = shared_users = None
+  if use_cache:
+    try:
+      header, blobs = _read_cache_file(cache_path)
+      if header.get('version') == cache_version and \
+         header.get('signature') == list(signature):
+        app_list = [(_str(uid), _str(name)) for uid, name in header['apps']]
+        shared_users = [(_str(uid), _str(name))
+                        for uid, name in header['shared_users']]
+    except (IOError, ValueError, TypeError, KeyError, AttributeError):
+      # a missing or malformed cache is rebuilt
+      app_list = shared_users = None
+  if app_list is None:
+    try:
+      _open_archive(sourcedir)
+      with timings.phase('packages.xml'):
+        app_list, shared_users = _iterparse_packages(pxml_path)
+    except OSError, e:
+      # no packages.xml in the archive
+      raise IOError(e.errno, e.strerror, pxml_path)
+    if use_cache:
+      _write_cache_file(cache_path, {'version': cache_version,
+                                     'signature': signature,
+                                     'apps': app_list,
+                                     'shared_users': shared_users})
+  _packages_memo[sourcedir] = (signature, app_list, shared_users)
+  return app_list, shared_users
+
+
+def _pack_stats (stats):
+  """
+    _pack_stats (stats)
+
+    arguments:
+    stats                -- a stats dictionary
+
+    packs the stats columns to strings of machine values (see
+    cache_typecodes). returns a (cpu ticks width, columns) tuple, or
+    None if the cpu ticks of the samples do not have the same length
+
+  """
+  widths = set(len(ticks) for ticks in stats.get('cpu_ticks', ()))
+  if len(widths) > 1:
+    return None
+  width = widths and widths.pop() or 0
+  columns = dict()
+  for key, l in stats.iteritems():
+    if key == 'cpu_ticks':
+      l = [tick for ticks in l for tick in ticks]
+    columns[key] = (cache_typecodes[key], array(cache_typecodes[key], l).tostring())
+  return width, columns
+
+def _unpack_stats (width, columns, keys=None, rows=None):
+  """
+    _unpack_stats (width, columns, keys=None, rows=None)
+
+    arguments:
+    width                -- the number of cpu ticks of each sample
+    columns              -- the packed columns (see _pack_stats)
+    keys                 -- unpack only the columns of these stats keys
+                            (all of them if not given)
+    rows                 -- unpack only these rows, in this order (all
+                            of them if not given)
+
+    returns the stats dictionary of the packed columns, each column
+    being an array of machine values (copied at once, without making
+    an object of each value) but the cpu ticks, a list per sample
+
+  """
+  stats = dict()
+  for key, (typecode, data) in columns.iteritems():
+    if keys is not None and key not in keys:
+      continue
+    column = array(typecode)
+    column.fromstring(data)
+    if key == 'cpu_ticks':
+      # split the flattened cpu ticks back to one list per sample (the
+      # samples may have no cpu ticks at all)
+      if rows is None:
+        time_typecode, time_data = columns['time']
+        length = len(time_data) // array(time_typecode).itemsize
+        ticks = column.tolist()
+        column = [ticks[i * width:(i + 1) * width] for i in xrange(length)]
+      else:
+        column = [column[row * width:(row + 1) * width].tolist() for row in rows]
+    elif rows is not None:
+      column = _take(column, rows)
+    stats[key] = column
+  return stats
+
+def _take (column, rows):
+  """
+    _take (column, rows)
+
+    arguments:
+    column               -- a stats column (a list or an array)
+    rows                 -- the indexes of the rows to be taken
+
+    returns a new column, of the same type, with the values of the
+    given rows
+
+  """
+  values = map(column.__getitem__, rows)
+  if isinstance(column, array):
+    return array(column.typecode, values)
+  return values
+
+def _write_cache_file (path, header, blobs=()):
+  """
+    _write_cache_file (path, header, blobs)
+
+    arguments:
+    path                 -- the path of the cache file
+    header               -- a dictionary of JSON values
+    blobs                -- a list of strings (e.g. packed columns)
+
+    write a cache file: a magic line, the header as a line of JSON
+    (with the sizes of the blobs) and the blobs one after the other.
+    The file is written under a temporary name and renamed, so that a
+    concurrent run never reads a partial file. failures (e.g. read-only
+    source directories) are ignored
+
+  """
+  header = dict(header, blobs=[len(blob) for blob in blobs])
+  tmp_path = '%s.%d' % (path, os.getpid())
+  try:
+    with open(tmp_path, 'wb') as cache_f:
+      cache_f.write(cache_magic)
+      cache_f.write(json.dumps(header, separators=(',', ':')))
+      cache_f.write('\n')
+      for blob in blobs:
+        cache_f.write(blob)
+    os.rename(tmp_path, path)
+  except (IOError, OSError):
+    try:
+      os.remove(tmp_path)
+    except OSError:
+      pass
+
+def _read_cache_file (path):
+  """
+    _read_cache_file (path)
+
+    arguments:
+    path                 -- the path of a cache file
+
+    returns the header and the blobs (buffers of the file data) of a
+    cache file (see _write_cache_file). Nothing in the file is ever
+    executed, so a cache shared along with a capture is safe to read.
+    raises IOError if it cannot be read and ValueError if it is not a
+    well-formed cache file
+
+  """
+  with open(path, 'rb') as cache_f:
+    data = cache_f.read()
+  if not data.startswith(cache_magic):
+    raise ValueError("not a cache file")
+  end = data.find('\n', len(cache_magic))
+  if end < 0:
+    raise ValueError("truncated cache header")
+  header = json.loads(data[len(cache_magic):end])
+  if not isinstance(header, dict):
+    raise ValueError("malformed cache header")
+  sizes = header.get('blobs')
+  if not isinstance(sizes, list) or \
+     not all(isinstance(size, (int, long)) and size >= 0 for size in sizes) or \
+     sum(sizes) != len(data) - end - 1:
+    raise ValueError("malformed cache blobs")
+  blobs = list()
+  offset = end + 1
+  for size in sizes:
+    blobs.append(buffer(data, offset, size))
+    offset += size
+  return header, blobs
+
+def _str (value):
+  # a JSON string (or null) as a (byte) string, as read from the logs
+  if value is None:
+    return None
+  if isinstance(value, unicode):
+    try:
+      return str(value)
+    except UnicodeEncodeError:
+      return value
+  if not isinstance(value, str):
+    raise TypeError("not a string: %r" % (value,))
+  return value
+
+def _encode_columns (packed, blobs):
+  """
+    _encode_columns (packed, blobs)
+
+    arguments:
+    packed               -- a (cpu ticks width, columns) tuple (see
+                            _pack_stats)
+    blobs                -- the list of the blobs of a cache file
+
+    returns the cache header entry of the packed columns, appending
+    their data to the blobs
+
+  """
+  width, columns = packed
+  entry = {'ticks_width': width, 'columns': dict()}
+  for key, (typecode, data) in columns.iteritems():
+    entry['columns'][key] = [typecode, len(blobs)]
+    blobs.append(data)
+  return entry
+
+def _decode_columns (entry, blobs):
+  """
+    _decode_columns (entry, blobs)
+
+    arguments:
+    entry                -- a cache header entry (see _encode_columns)
+    blobs                -- the blobs of the cache file
+
+    returns the (cpu ticks width, columns) tuple of the given entry.
+    raises ValueError (or TypeError, KeyError, IndexError) if the
+    columns are not all stats columns of the same number of rows
+
+  """
+  width = entry['ticks_width']
+  if not isinstance(width, int) or width < 0:
+    raise ValueError("malformed cpu ticks width")
+  columns = dict()
+  lengths = set()
+  for key, (typecode, index) in entry['columns'].iteritems():
+    key = _str(key)
+    if cache_typecodes.get(key) != typecode:
+      raise ValueError("malformed cache column %s" % key)
+    data = blobs[index]
+    itemsize = array(typecode).itemsize
+    if len(data) % itemsize:
+      raise ValueError("malformed cache column %s" % key)
+    length = len(data) // itemsize
+    if key == 'cpu_ticks':
+      if (width == 0 and length) or (width and length % width):
+        raise ValueError("malformed cache column %s" % key)
+      if width:
+        lengths.add(length // width)
+    else:
+      lengths.add(length)
+    columns[key] = (cache_typecodes[key], data)
+  if len(lengths) > 1:
+    raise ValueError("cache columns of different lengths")
+  return width, columns
+
+def _decode_cache (header, blobs):
+  """
+    _decode_cache (header, blobs)
+
+    arguments:
+    header               -- the header of a session cache file
+    blobs                -- its blobs
+
+    returns the session cache dictionary (manifest, last second, PID
+    index, rows index, packed columns and pyramid) of a cache file,
+    with the types the session uses. raises ValueError (or TypeError,
+    KeyError, IndexError, AttributeError) if it is malformed
+
+  """
+  def signature(value):
+    if value is None:
+      return None
+    mtime, size = value
+    return (float(mtime) if isinstance(mtime, float) else int(mtime), int(size))
+  manifest = dict((int(second), (signature(raw), signature(power)))
+                  for second, (raw, power) in header['manifest'])
+  width, columns = _decode_columns(header['columns'], blobs)
+  length = len(columns['time'][1]) // array('l').itemsize
+  pids = dict((_str(pid), (_str(uid), _str(tgid)))
+              for pid, (uid, tgid) in header['pids'].iteritems())
+  pid_seconds = dict((_str(pid), int(second))
+                     for pid, second in header['pid_seconds'].iteritems())
+  if set(pid_seconds) != set(pids):
+    raise ValueError("malformed PID index")
+  rows = dict()
+  for level in ('pid', 'uid'):
+    values, index = header['rows'][level]
+    all_rows = array('l')
+    all_rows.fromstring(blobs[index])
+    if sum(count for value, count in values) != len(all_rows) or \
+       (all_rows and (min(all_rows) < 0 or max(all_rows) >= length)):
+      raise ValueError("malformed rows index")
+    rows[level] = dict()
+    offset = 0
+    for value, count in values:
+      rows[level][_str(value)] = all_rows[offset:offset + count]
+      offset += count
+  pyramid = header['pyramid']
+  if pyramid is not None:
+    pyramid = dict((int(size), _decode_columns(entry, blobs))
+                   for size, entry in pyramid.iteritems())
+  return {'manifest': manifest,
+          'last_second': int(header['last_second']),
+          'pids': pids,
+          'pid_seconds': pid_seconds,
+          'rows': rows,
+          'ticks_width': width,
+          'columns': columns,
+          'pyramid': pyramid,
+          'source': header.get('source')}
+
+def _read_lines (fn):
+  """
+    _read_lines (fn)
+
+    arguments:
+    fn                   -- the path of the file to be read
+
+    returns the lines of a file, without the line endings. The file
+    is read with a single read call of its whole size (the logs are
+    tiny, so there is nothing to gain from buffered reads or mmap) and
+    the lines are split once, with no intermediate list copies. The
+    files of an archive are already in memory
+
+  """
+  archive, name = _archive_file(fn)
+  if archive:
+    data = archive.member(name)[1]
+    lines = data.split('\n')
+    if not lines[-1]:
+      lines.pop()
+    return lines
+  fd = os.open(fn, os.O_RDONLY)
+  try:
+    size = os.fstat(fd).st_size
+    data = os.read(fd, size + 1)
+    if len(data) != size:
+      # short read, or the file grew since fstat (e.g. it is still
+      # being written): read the rest of it
+      chunks = [data]
+      while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+          break
+        chunks.append(chunk)
+      data = ''.join(chunks)
+  finally:
+    os.close(fd)
+  timings.count('files opened')
+  timings.count('bytes read', len(data))
+  lines = data.split('\n')
+  # the last (empty) element after the final line ending
+  if not lines[-1]:
+    lines.pop()
+  return lines
+
+def _read_second (raw_fn, power_fn):
+  """
+    _read_second (raw_fn, power_fn)
+
+    arguments:
+    raw_fn               -- the usage (raw) log file of a second
+    power_fn             -- the power log file of the second (or None)
+
+    returns the usage lines (without the header) and the power
+    lines (without the last line) of a second
+
+  """
+  raw_lines = _read_lines(raw_fn)
+  del raw_lines[:1]
+  power_lines = []
+  if power_fn:
+    power_lines = _read_lines(power_fn)
+    del power_lines[-1:]
+  return raw_lines, power_lines
+
+
+def _scan_numbers (lines):
+  """
+    _scan_numbers (lines)
+
+    arguments:
+    lines                -- lines of numbers separated by single spaces
+
+    returns the list of the numbers (ints or floats) of each line. The
+    lines are scanned as one JSON document, so that they are split and
+    converted in a single pass, in C: with a comma in place of each
+    space a line is the body of a JSON array, and the lines joined by
+    "],[" are the body of an array of arrays:
+
+      "1 2 3", "4 5 6"  ->  [[1,2,3],[4,5,6]]
+
+    raises ValueError if a line is not such a list of numbers (e.g. two
+    spaces in a row, a leading or trailing space, or an empty line)
+
+  """
+  document = '[[' + '],['.join(lines).replace(' ', ',') + ']]'
+  return json.loads(document)
+
+def _tokenize_lines (lines, width, chars):
+  """
+    _tokenize_lines (lines, width, chars)
+
+    arguments:
+    lines                -- the lines of a log file
+    width                -- the number of fields of each line
+    chars                -- the characters the fields are made of
+
+    returns a list with the values (ints or floats) of the fields of
+    each line (see _scan_numbers), or None if a line is malformed: a
+    wrong number of fields, other characters or more than one space
+    between two fields
+
+  """
+  if not lines:
+    return []
+  # the JSON scanner would also accept e.g. true, null or 1e3
+  if '\n'.join(lines).translate(None, chars + '\n'):
+    return None
+  try:
+    rows = _scan_numbers(lines)
+  except ValueError:
+    return None
+  if set(map(len, rows)) != set([width]):
+    return None
+  return rows
+
+def _parse_second (second, raw_lines, power_lines, pid=None, uid=None, keys=None):
+  """
+    _parse_second (second, raw_lines, power_lines, pid, uid, keys)
+
+    arguments:
+    second               -- the second the lines belong to
+    raw_lines            -- the lines of the usage (raw) log (without header)
+    power_lines          -- the lines of the power log (without the last line)
+    pid                  -- decode only the samples of this PID (string)
+    uid                  -- decode only the samples of this UID (string)
+    keys                 -- decode only the values of these stats keys
+                            (all of them if not given)
+
+    returns a sequence of (PID, TGID, UID, sample) tuples, one for
+    each well-formed line of the usage log, where sample is a tuple
+    with the values of the stats_keys, or None if the line has no
+    (well-formed) power sample or does not match the given PID (or
+    UID). The malformed lines are skipped and counted in parse_errors.
+    When all the values are asked for, the lines of both logs are
+    tokenized at once (see _tokenize_lines), falling back to checking
+    them one by one if any is malformed
+
+  """
+  if keys is None:
+    keys = stats_keys
+  if not pid and not uid and len(keys) == len(stats_keys):
+    rows = _tokenize_lines(raw_lines, raw_fields, raw_chars)
+    if rows is not None:
+      energies = _tokenize_lines(power_lines, power_fields, power_chars)
+      if energies is not None:
+        return _tokenized_samples(second, rows, energies)
+  return _parse_lines(second, raw_lines, power_lines, pid, uid, keys)
+
+def _tokenized_samples (second, rows, energies):
+  # the samples of the tokenized lines of a second
+  if len(rows) != len(energies):
+    _count_unmatched(second, len(rows), len(energies))
+  samples = list()
+  append = samples.append
+  ticks_end = 3 + cpu_frequencies
+  for row, values in izip(rows, energies):
+    # the JSON scanner gives ints for the energies written without a
+    # decimal point, e.g. 0
+    CPU_en, DISP_en, GPS_en, WIFI_en, G3_en = map(float, values)
+    # compute the total energy
+    total_en = CPU_en + DISP_en + GPS_en + WIFI_en + G3_en
+    disp, gps, wifi_snd_pkts, wifi_rcv_pkts, g3_low, g3_high, calling = row[ticks_end:]
+    append( (str(row[0]), str(row[1]), str(row[2]),
+             (second, row[0], row[1], row[2], row[3:ticks_end], disp, gps,
+              wifi_snd_pkts, wifi_rcv_pkts, g3_low, g3_high, calling,
+              CPU_en, DISP_en, GPS_en, WIFI_en, G3_en, total_en)) )
+  # usage samples without a power sample are not reported
+  for row in rows[len(energies):]:
+    append( (str(row[0]), str(row[1]), str(row[2]), None) )
+  return samples
+
+def _count_unmatched (second, raw_count, power_count):
+  # the lines of a second without a line in the other log
+  if raw_count > power_count:
+    parse_errors.add('usage lines without a power line', second, 'power',
+                     power_count + 1, None, raw_count - power_count)
+  elif power_count > raw_count:
+    parse_errors.add('power lines without a usage line', second, 'power',
+                     raw_count + 1, None, power_count - raw_count)
+
+def _parse_lines (second, raw_lines, power_lines, pid=None, uid=None, keys=None):
+  """
+    _parse_lines (second, raw_lines, power_lines, pid, uid, keys)
+
+    same as _parse_second, checking the lines one by one: a generator
+    that splits each usage line once, only its first three fields when
+    it does not match the given PID or UID or when neither the cpu
+    ticks nor the usage values are asked for, and converts only the
+    values of the keys asked for (the others are set to 0)
+
+  """
+  ticks_wanted = 'cpu_ticks' in keys
+  # the positions of the usage values asked for in a usage line
+  usage_wanted = [(i, raw_fields - len(usage_keys) + i)
+                  for i, key in enumerate(usage_keys) if key in keys]
+  decode_all = ticks_wanted and len(usage_wanted) == len(usage_keys)
+  power_wanted = any(key in keys for key in power_keys)
+  usage = [0] * len(usage_keys)
+  energies = (0,) * len(power_keys)
+  cpu_ticks = 0
+  n_power = len(power_lines)
+  if len(raw_lines) != n_power:
+    _count_unmatched(second, len(raw_lines), n_power)
+  for index, r_line in enumerate(raw_lines):
+    if pid or uid:
+      # skip the lines of the other processes before splitting them
+      head = r_line.split(None, 3)
+      if len(head) == 4 and (head[0] != pid if pid else head[2] != uid):
+        yield head[0], head[1], head[2], None
+        continue
+    # extract information from the usage log
+    if ticks_wanted or usage_wanted:
+      fields = r_line.split()
+      well_formed = len(fields) == raw_fields
+    else:
+      # only the ids are needed: the number of fields is told by the
+      # spaces, unless the fields are not separated by single spaces
+      fields = r_line.split(None, 3)
+      well_formed = (r_line.count(' ') == raw_fields - 1 and '  ' not in r_line and
+                     r_line[:1] != ' ' and r_line[-1:] != ' ') or \
+                    len(r_line.split()) == raw_fields
+    if not well_formed:
+      parse_errors.add('usage lines with a wrong number of fields', second,
+                       'raw', index + 2, r_line)
+      continue
+    PID, TGID, UID = fields[:3]
+    # usage samples without a power sample are not reported
+    if index >= n_power:
+      yield PID, TGID, UID, None
+      continue
+    try:
+      if decode_all:
+        # the ids, the cpu ticks per different frequencies, then the
+        # usage values
+        values = map(int, fields)
+        sample = ((second,) + tuple(values[:3]) +
+                  (values[3:3 + cpu_frequencies],) +
+                  tuple(values[3 + cpu_frequencies:]))
+      else:
+        ids = (int(PID), int(TGID), int(UID))
+        if ticks_wanted:
+          cpu_ticks = map(int, fields[3:3 + cpu_frequencies])
+        for i, position in usage_wanted:
+          usage[i] = int(fields[position])
+        sample = (second,) + ids + (cpu_ticks,) + tuple(usage)
+    except ValueError:
+      parse_errors.add('usage lines with a field not a number', second,
+                       'raw', index + 2, r_line)
+      continue
+    if power_wanted:
+      # extract information from the power log
+      values = power_lines[index].split()
+      if len(values) != power_fields:
+        parse_errors.add('power lines with a wrong number of fields', second,
+                         'power', index + 1, power_lines[index])
+        yield PID, TGID, UID, None
+        continue
+      try:
+        CPU_en, DISP_en, GPS_en, WIFI_en, G3_en = map(float, values)
+      except ValueError:
+        parse_errors.add('power lines with a field not a number', second,
+                         'power', index + 1, power_lines[index])
+        yield PID, TGID, UID, None
+        continue
+      # compute the total energy
+      total_en = CPU_en + DISP_en + GPS_en + WIFI_en + G3_en
+      energies = (CPU_en, DISP_en, GPS_en, WIFI_en, G3_en, total_en)
+    yield PID, TGID, UID, sample + energies
+
+
+def _parse_seconds (task):
+  """
+    _parse_seconds (task)
+
+    arguments:
+    task                 -- a (seconds, keys, restriction) tuple: a list
+                            of (second, raw_fn, power_fn) tuples, the
+                            stats keys to be decoded (None for all of
+                            them) and the (PID, UID) whose samples are
+                            kept (see Session.restrict)
+
+    parse the log files of the given seconds (used by the worker
+    processes when parsing in parallel). returns the PID index, the
+    first second of each PID, the rows index, the packed samples (or
+    the stats dictionary itself, if it cannot be packed), the
+    malformed lines skipped (see ParseErrors) and the counters of the
+    files and lines read (see Timings)
+
+  """
+  seconds, keys, restriction = task
+  # only the lines and files of this task are reported back
+  parse_errors.clear()
+  timings.clear_counters()
+  session = Session(None, use_cache=False, keys=keys)
+  session.restrict(*(restriction or ()))
+  for second, raw_fn, power_fn in seconds:
+    raw_lines, power_lines = _read_second(raw_fn, power_fn)
+    session._add_second(second, raw_lines, power_lines)
+  packed = _pack_stats(session.stats)
+  return (session.pids, session.pid_seconds, session.rows,
+          packed or session.stats, parse_errors.state(),
+          timings.counter_state())
+
+
+def _aggregate_apps (stats, with_series=False):
+  """
+    _aggregate_apps (stats, with_series=False)
+
+    arguments:
+    stats                -- the stats dictionary of a session
+    with_series          -- also sum the samples of every second
+
+    sum the energy of the samples per app (UID) in a single pass.
+    returns the per-component totals, the set of PIDs and (if asked)
+    the per-second totals of each UID
+
+  """
+  columns = [stats['uid'], stats['pid'], stats['time']] + \
+            [stats[key] for key in power_keys]
+  # UID -> per-component totals, PIDs and per-second totals
+  totals, pids, series = dict(), dict(), dict()
+  with timings.phase('aggregate'):
+    rows = zip(*columns)
+    for row in rows:
+      uid, pid, time, energies = row[0], row[1], row[2], row[3:]
+      if uid not in totals:
+        totals[uid] = [0] * len(power_keys)
+        pids[uid] = set()
+        series[uid] = dict()
+      app_totals = totals[uid]
+      for i, energy in enumerate(energies):
+        app_totals[i] += energy
+      pids[uid].add(pid)
+      if with_series:
+        second_totals = series[uid].setdefault(time, [0] * len(power_keys))
+        for i, energy in enumerate(energies):
+          second_totals[i] += energy
+  return totals, pids, series
+
+
+def _rollup_processes (stats, rows=None):
+  """
+    _rollup_processes (stats, rows=None)
+
+    arguments:
+    stats                -- the stats dictionary of a session
+    rows                 -- the rows to be summed up (all of them if
+                            not given)
+
+    sum the energy of the samples per process (PID), thread group
+    (TGID) and app (UID) in a single pass. returns a dictionary with
+    the per-component totals of each process, thread group and app
+    (level -> key -> totals), keyed by (UID, TGID, PID), (UID, TGID)
+    and UID respectively: a reused PID (or TGID) is a different process
+    under each app, and each one is summed up on its own
+
+  """
+  totals = {'pid': dict(), 'tgid': dict(), 'uid': dict()}
+  ids = [stats['pid'], stats['tgid'], stats['uid']]
+  columns = [stats[key] for key in power_keys]
+  if rows is None:
+    rows = xrange(len(stats['time']))
+  with timings.phase('rollup'):
+    for row in rows:
+      pid, tgid, uid = [column[row] for column in ids]
+      energies = [column[row] for column in columns]
+      for level, key in (('pid', (uid, tgid, pid)), ('tgid', (uid, tgid)),
+                         ('uid', uid)):
+        level_totals = totals[level]
+        if key not in level_totals:
+          level_totals[key] = [0] * len(power_keys)
+        key_totals = level_totals[key]
+        for i, energy in enumerate(energies):
+          key_totals[i] += energy
+  return totals
+
+
+def _report_device (args):
+  """
+    _report_device (args)
+
+    arguments:
+    args                 -- a (sourcedir, use_cache, first, last) tuple
+
+    load the capture of a device and sum the energy of its apps (used
+    by the worker processes of a batch report). returns the source
+    directory, the package names of its UIDs, the per-component totals,
+    the number of PIDs of each UID and the malformed lines skipped
+
+  """
+  sourcedir, use_cache, first, last = args
+  # only the lines of this device are reported back
+  parse_errors.clear()
+  p = LogStats(sourcedir, False, False, '', '', '', '', use_cache=use_cache,
+               first=first, last=last)
+  p.session.project(power_keys)
+  app_dict = dict(p._parse_packages_xml())
+  # explicitly add the system UID
+  app_dict['0'] = 'system'
+  totals, pids, series = _aggregate_apps(p.session.load().stats)
+  apps = dict((uid, app_dict.get(str(uid), '?')) for uid in totals)
+  return (sourcedir, apps, totals, dict((uid, len(pids[uid])) for uid in pids),
+          parse_errors.state())
+
+
+def _expand_sourcedirs (patterns):
+  """
+    _expand_sourcedirs (patterns)
+
+    arguments:
+    patterns             -- a list of directories, archives or glob
+                            patterns
+
+    returns the source directories (and archives) matched by the given
+    patterns, in
+    order and without duplicates. a pattern that matches nothing is
+    kept as is, so that it is reported as a missing directory
+
+  """
+  sourcedirs = list()
+  for pattern in patterns:
+    matches = sorted(fn for fn in glob.glob(pattern)
+                     if os.path.isdir(fn) or _is_archive(fn))
+    for sourcedir in matches or [pattern]:
+      if sourcedir not in sourcedirs:
+        sourcedirs.append(sourcedir)
+  return sourcedirs
+
+
+class Session:
+  """
+    Session (class)
+
+    An in-memory model of an AppScope capture. The source directory
+    is scanned once and both the PID index and the samples of every
+    process are kept, so that all the actions can be answered from
+    the same data
+  """
+
+  def __init__(self, sourcedir, use_cache=True, jobs=1, first=None, last=None,
+               keys=None):
+    """
+      Constructor of Session objects
+
+      Creates a new (not yet loaded) Session object. If a time range
+      (first, last) is given, only the log files of those seconds are
+      read and the cache, which holds whole sessions, is not used. If
+      stats keys are given, only their columns are kept (see project)
+    """
+    self.sourcedir = sourcedir
+    self.first = first
+    self.last = last
+    self.use_cache = use_cache and first is None and last is None
+    # the number of processes used to parse the log files
+    self.jobs = jobs
+    # PID -> (UID, TGID) mapping, all as strings
+    self.pids = dict()
+    # PID -> the second it first appeared in
+    self.pid_seconds = dict()
+    # PID (and UID) -> the rows of its samples in the samples table,
+    # so that a single process (or app) query does not scan all of them
+    self.rows = {'pid': dict(), 'uid': dict()}
+    # the samples of all the processes
+    self.stats = _new_stats_dict()
+    # window size -> the samples of each process summed up in windows
+    # of that size (see pyramid_levels), read from the cache
+    self.pyramid = None
+    # the first second of the samples missing from the pyramid, whose
+    # windows are summed up again when the cache is written
+    self._pyramid_start = 0
+    self.loaded = False
+    # the stats keys kept (None for all of them)
+    self.keys = None
+    # the (PID, UID) whose samples are kept (None for all of them)
+    self.restriction = None
+    if keys is not None:
+      self.project(keys)
+    # the signatures of the log files found in the cache
+    self._cached_manifest = None
+    # the signature and time range of the archive (see load)
+    self._source = None
+
+  def project(self, keys):
+    """
+      project(keys)
+
+      arguments:
+      keys           -- the stats keys to be kept (None for all)
+
+      keep only the columns of the given stats keys (and the ones of
+      the indexes) when the session is loaded: the values of the other
+      keys are neither parsed nor read from the cache. The cache is
+      still written with all the columns, so the log files are fully
+      parsed when it has to be updated
+
+    """
+    if self.loaded:
+      return
+    if keys is not None:
+      keys = set(index_keys).union(keys)
+    if keys is None or len(keys) == len(stats_keys):
+      self.keys = None
+      self.stats = _new_stats_dict()
+      return
+    self.keys = keys
+    self.stats = dict((key, l) for key, l in _new_stats_dict().iteritems()
+                      if key in self.keys)
+
+  def restrict(self, pid=None, uid=None):
+    """
+      restrict(pid, uid)
+
+      arguments:
+      pid            -- keep only the samples of this PID (string)
+      uid            -- keep only the samples of this UID (string)
+
+      keep only the samples of the given PID, or UID if no PID is
+      given, when the session is loaded: the lines of the other
+      processes are not fully parsed (nor counted if malformed) and the
+      other rows of the cache are not unpacked, so select returns
+      nothing for them. The PID
+      index still holds all the processes. Like project, it does not
+      apply when the cache has to be written
+
+    """
+    if self.loaded:
+      return
+    self.restriction = (pid, uid) if pid or uid else None
+
+  def load(self, parse=True):
+    """
+      load(parse=True)
+
+      arguments:
+      parse          -- parse the log files that are not cached (if
+                        not, the session is loaded only from an up to
+                        date cache)
+
+      fill in the PID index and the samples table, from the on-disk
+      cache if there is one, parsing only the log files of the seconds
+      that are not cached yet (or whose files changed since). returns
+      the session, or None if it is not loaded
+
+    """
+    if self.loaded:
+      return self
+    if not parse and not self.use_cache:
+      return None
+    start = None
+    if self.use_cache and _is_archive(self.sourcedir):
+      # an archive changes as a whole: as long as it does not, its
+      # cache is up to date and the archive is not read at all
+      self._source = list(_file_signature(self.sourcedir)) + [self.first, self.last]
+      with timings.phase('cache read'):
+        start = self._read_cache(None)
+    if start is not None:
+      seconds = []
+      manifest = self._cached_manifest
+    else:
+      with timings.phase('list'):
+        seconds = _list_seconds(self.sourcedir, self.first, self.last)
+      manifest = None
+    if self.use_cache and start is None:
+      with timings.phase('cache read'):
+        manifest = dict((second, (_file_signature(raw_fn), _file_signature(power_fn)))
+                        for second, raw_fn, power_fn in seconds)
+        start = self._read_cache(manifest, parse)
+      if start is not None:
+        seconds = [entry for entry in seconds if entry[0] >= start]
+      elif not parse:
+        return None
+      else:
+        # the cache, to be written, holds all the columns and samples
+        self.project(None)
+        self.restrict()
+    if self.jobs > 1 and len(seconds) > self.jobs:
+      with timings.phase('parse (parallel)'):
+        self._parse_parallel(seconds)
+    else:
+      for second, raw_fn, power_fn in seconds:
+        with timings.phase('read'):
+          raw_lines, power_lines = _read_second(raw_fn, power_fn)
+        with timings.phase('parse'):
+          self._add_second(second, raw_lines, power_lines)
+    self.loaded = True
+    if self.use_cache and manifest != self._cached_manifest:
+      with timings.phase('cache write'):
+        self._write_cache(manifest)
+    return self
+
+  def _parse_parallel(self, seconds):
+    """
+      _parse_parallel(seconds)
+
+      arguments:
+      seconds        -- a list of (second, raw_fn, power_fn) tuples
+
+      split the seconds in consecutive chunks that are parsed by a
+      pool of worker processes, and merge the partial results in time
+      order into the PID index and the samples table
+
+    """
+    import multiprocessing
+    # a few chunks per process, to balance the load
+    size = max(1, len(seconds) // (self.jobs * 4))
+    chunks = [seconds[i:i+size] for i in xrange(0, len(seconds), size)]
+    pool = multiprocessing.Pool(self.jobs)
+    try:
+      tasks = [(chunk, self.keys, self.restriction) for chunk in chunks]
+      for pids, pid_seconds, rows, stats, errors, counters in pool.imap(_parse_seconds, tasks):
+        parse_errors.merge(errors)
+        timings.merge_counters(counters)
+        if isinstance(stats, tuple):
+          stats = _unpack_stats(*stats)
+        for pid, second in pid_seconds.iteritems():
+          if not self.pids.has_key(pid):
+            self.pids[pid] = pids[pid]
+            self.pid_seconds[pid] = second
+        # the rows of the chunk follow the ones already merged
+        offset = len(self.stats['time'])
+        for level, index in rows.iteritems():
+          for value, value_rows in index.iteritems():
+            self.rows[level].setdefault(value, array('l')).extend(
+              array('l', [row + offset for row in value_rows]))
+        for key, l in stats.iteritems():
+          self.stats[key].extend(l)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _cache_path(self):
+    return _cache_file(self.sourcedir, cache_filename)
+
+  def _read_cache(self, manifest, partial=True):
+    """
+      _read_cache(manifest, partial=True)
+
+      arguments:
+      manifest       -- the signatures of the log files currently found,
+                        or None to use the cache only if it was written
+                        for the same archive (and time range)
+      partial        -- also use a cache that is not up to date
+
+      load the PID index and the samples table from the on-disk cache,
+      dropping the seconds from the first one whose log files changed
+      onwards. If the cache is up to date, only the columns of the
+      projected keys are unpacked. returns the first second that still
+      has to be parsed, or None if there is no usable cache
+
+    """
+    try:
+      header, blobs = _read_cache_file(self._cache_path())
+      if header.get('version') != cache_version:
+        return None
+      cache = _decode_cache(header, blobs)
+    except (IOError, ValueError, TypeError, KeyError, IndexError, AttributeError):
+      # a missing, outdated or malformed cache is rebuilt
+      return None
+    cached_manifest = cache['manifest']
+    if manifest is None:
+      if cache['source'] is None or cache['source'] != self._source:
+        return None
+      manifest = cached_manifest
+    # the seconds that changed, disappeared or showed up in between
+    # the cached ones (usually only the last one, if it was still
+    # being written when the cache was built)
+    last_second = cache['last_second']
+    stale = [second for second, signature in cached_manifest.iteritems()
+             if manifest.get(second) != signature]
+    stale += [second for second in manifest
+              if second <= last_second and second not in cached_manifest]
+    if stale:
+      start = min(stale)
+    else:
+      start = last_second + 1
+    cached_manifest = dict((second, signature)
+                           for second, signature in cached_manifest.iteritems()
+                           if second < start)
+    if not partial and cached_manifest != manifest:
+      return None
+    self._cached_manifest = cached_manifest
+    if self._cached_manifest != manifest:
+      # the cache, to be updated, holds all the columns and samples
+      self.project(None)
+      self.restrict()
+
+    rows = None
+    if self.restriction is not None:
+      # only the rows of the PID (or UID), found in the rows index
+      pid, uid = self.restriction
+      if pid:
+        rows = cache['rows']['pid'].get(pid, ())
+      else:
+        rows = cache['rows']['uid'].get(uid, ())
+    self.stats = _unpack_stats(cache['ticks_width'], cache['columns'], self.keys, rows)
+    if self._cached_manifest != manifest:
+      # the samples of the seconds parsed again are appended to lists
+      self.stats = dict((key, l if key == 'cpu_ticks' else l.tolist())
+                        for key, l in self.stats.iteritems())
+    if cache['pyramid'] is not None:
+      self.pyramid = dict((size, _unpack_stats(width, columns, self.keys))
+                          for size, (width, columns) in cache['pyramid'].iteritems())
+      if self._cached_manifest != manifest:
+        # drop the windows of the seconds to be parsed again, from the
+        # one of the first second onwards
+        for size, level in self.pyramid.iteritems():
+          rows = bisect_left(level['time'], start - start % size)
+          for l in level.itervalues():
+            del l[rows:]
+        self._pyramid_start = start
+
+    # drop the samples and the PIDs of the seconds to be parsed again
+    rows = bisect_left(self.stats['time'], start)
+    for l in self.stats.itervalues():
+      del l[rows:]
+    for pid, second in cache['pid_seconds'].iteritems():
+      if second < start:
+        self.pids[pid] = cache['pids'][pid]
+        self.pid_seconds[pid] = second
+    if self.restriction is not None:
+      # the rows index of the samples kept
+      pid_rows, uid_rows = self.rows['pid'], self.rows['uid']
+      for row, (PID, UID) in enumerate(izip(self.stats['pid'], self.stats['uid'])):
+        pid_rows.setdefault(str(PID), array('l')).append(row)
+        uid_rows.setdefault(str(UID), array('l')).append(row)
+      return start
+    for level, index in cache['rows'].iteritems():
+      for value, value_rows in index.iteritems():
+        del value_rows[bisect_left(value_rows, rows):]
+        if value_rows:
+          self.rows[level][value] = value_rows
+    return start
+
+  def _write_cache(self, manifest):
+    """
+      _write_cache(manifest)
+
+      arguments:
+      manifest       -- the signatures of the parsed log files
+
+      store the PID index and the samples table in the on-disk cache.
+      failures (e.g. read-only source directories) are ignored
+
+    """
+    packed = _pack_stats(self.stats)
+    if packed is None:
+      # the cpu ticks cannot be stored as a flat column
+      self.pyramid = None
+      return
+    with timings.phase('pyramid'):
+      self._build_pyramid()
+    # the columns and the rows index are stored as blobs of machine
+    # values, everything else in the (JSON) header
+    blobs = list()
+    rows = dict()
+    for level, index in self.rows.iteritems():
+      values = sorted(index)
+      rows[level] = [[value, len(index[value])] for value in values], len(blobs)
+      blobs.append(''.join(index[value].tostring() for value in values))
+    header = {'version': cache_version,
+              'manifest': sorted(manifest.iteritems()),
+              'last_second': max(manifest or [-1]),
+              'pids': self.pids,
+              'pid_seconds': self.pid_seconds,
+              'rows': rows,
+              'columns': _encode_columns(packed, blobs),
+              'pyramid': None,
+              'source': self._source}
+    pyramid = dict((size, _pack_stats(stats))
+                   for size, stats in self.pyramid.iteritems())
+    if None not in pyramid.values():
+      header['pyramid'] = dict((size, _encode_columns(packed_level, blobs))
+                               for size, packed_level in pyramid.iteritems())
+    _write_cache_file(self._cache_path(), header, blobs)
+    self._cached_manifest = manifest
+
+  def _add_second(self, second, raw_lines, power_lines):
+    """
+      _add_second(second, raw_lines, power_lines)
+
+      arguments:
+      second         -- the second the lines belong to
+      raw_lines      -- the lines of the usage (raw) log (without header)
+      power_lines    -- the lines of the power log (without the last line)
 
-    arguments:
-    samples              -- a dictionary with the sample lists
-    key                  -- the key list to be used for the comparison
+      index the PIDs found in the usage log and append the samples
+      of the second to the samples table
 
-    sum up n same sized lists based contained in a dictionary
-    based on identical elements of the one given by a dictionary
-    key
+    """
+    timings.count('lines parsed', len(raw_lines))
+    columns = [self.stats[key] for key in stats_keys if key in self.stats]
+    # the values of the sample tuples that are kept
+    projected = itemgetter(*[i for i, key in enumerate(stats_keys)
+                             if key in self.stats])
+    pid_rows, uid_rows = self.rows['pid'], self.rows['uid']
+    row = len(self.stats['time'])
+    pid, uid = self.restriction or (None, None)
+    for PID, TGID, UID, sample in _parse_second(second, raw_lines, power_lines,
+                                                pid=pid, uid=uid, keys=self.keys):
+      # insert PID, UID mapping in the index
+      if not self.pids.has_key(PID):
+        self.pids[PID] = (UID, TGID)
+        self.pid_seconds[PID] = second
+      if sample is not None:
+        if self.keys is not None:
+          sample = projected(sample)
+        map(list.append, columns, sample)
+        if PID not in pid_rows:
+          pid_rows[PID] = array('l')
+        pid_rows[PID].append(row)
+        if UID not in uid_rows:
+          uid_rows[UID] = array('l')
+        uid_rows[UID].append(row)
+        row += 1
+
+  def iter_samples(self, pid=None, uid=None):
+    """
+      iter_samples(pid, uid)
 
-  """
-  # required modules:
-  # from itertools import groupby
-  # from operator import itemgetter
+      arguments:
+      pid            -- yield only the samples of this PID (string)
+      uid            -- yield only the samples of this UID (string)
 
-  # construct a list with all the key names (starting from 'time')
-  keys = ['time'] + [key for key in samples.keys() if key!='time']
-  # construct a list with all the keys' lists (starting from the one of 'time')
-  keys_lists = [ samples['time'] ] + [samples[key] for key in samples.keys() if key!='time']
-  groups = groupby(zip(*keys_lists), key=itemgetter(0))
-  lists = zip(*[[k] + map(_sum, zip(*g)[1:]) for k, g in groups])
-  new_d = dict(zip((keys), lists))
-  return new_d
+      generator that parses the log files one second at a time and
+      yields the matching sample tuples in time order, without
+      loading the whole session in memory (the cache is not used)
 
+    """
+    with timings.phase('list'):
+      seconds = _list_seconds(self.sourcedir, self.first, self.last)
+    for second, raw_fn, power_fn in seconds:
+      for sample in self._second_samples(second, raw_fn, power_fn, pid, uid):
+        yield sample
 
+  def follow_seconds(self, pid=None, uid=None):
+    """
+      follow_seconds(pid, uid)
 
-def _new_stats_dict():
-  """
-    _new_stats_dict function
+      arguments:
+      pid            -- yield only the samples of this PID (string)
+      uid            -- yield only the samples of this UID (string)
+
+      generator that follows a recording session, yielding the list
+      of the matching samples of every second once the next second
+      has started. Only the directories of the seconds right after
+      the last one parsed are looked into (the source directory is
+      listed again only after a few idle looks), so the cost of each
+      look does not grow with the length of the session. Without a
+      time range it starts from the last complete second, otherwise
+      from the first one of the range, and ends after its last one
 
-    creates a new stats dictionary containing 6 lists with
-    the following keys: time, cpu, display, gps, wifi, 3g
-  """
-  return {'time':[],
-          'cpu':[],
-          'display':[],
-          'gps':[],
-          'wifi':[],
-          '3g':[]
-         }
+    """
+    def listed(after):
+      # the seconds found in the source directory after this one
+      try:
+        names = os.listdir(self.sourcedir)
+      except OSError:
+        return []
+      return sorted(second for second in (int(name) for name in names if name.isdigit())
+                    if second > after)
+
+    # the seconds found but not parsed yet: without a time range, only
+    # the last complete second and the one being written
+    if self.first is None:
+      known = listed(-1)[-2:]
+    else:
+      known = listed(self.first - 1)
+    # the last second parsed
+    current = (known[0] if known else self.first or 0) - 1
+    idle = 0
+    while self.last is None or current < self.last:
+      # look for the seconds following the last one found
+      probe = known[-1] + 1 if known else current + 1
+      while os.path.isdir(os.path.join(self.sourcedir, str(probe))):
+        known.append(probe)
+        probe += 1
+      if len(known) < 2:
+        idle += 1
+        if idle % follow_rescan == 0:
+          known = listed(current)
+        if len(known) < 2:
+          time.sleep(follow_interval)
+          continue
+      idle = 0
+      # all the seconds but the last one found are complete
+      for second in known[:-1]:
+        if self.last is not None and second > self.last:
+          return
+        raw_fns, power_fns = _list_dir(self.sourcedir, second)
+        for raw_second, raw_fn in sorted(raw_fns):
+          yield self._second_samples(raw_second, raw_fn, power_fns.get(raw_second),
+                                     pid, uid)
+        current = second
+      known = known[-1:]
+
+  def _second_samples(self, second, raw_fn, power_fn, pid=None, uid=None):
+    # read and parse the log files of a second, keeping the samples
+    # of the given PID (or UID)
+    with timings.phase('read'):
+      raw_lines, power_lines = _read_second(raw_fn, power_fn)
+    with timings.phase('parse'):
+      samples = [sample for PID, TGID, UID, sample
+                 in _parse_second(second, raw_lines, power_lines, pid=pid, uid=uid,
+                                  keys=self.keys)
+                 if sample is not None]
+    timings.count('lines parsed', len(raw_lines))
+    timings.count('rows kept', len(samples))
+    return samples
+
+  def select(self, pid=None, uid=None, first=None, last=None, keys=None):
+    """
+      select(pid, uid, first, last, keys)
 
-def _new_stats_dict():
-  """
-    _new_stats_dict function
+      arguments:
+      pid            -- keep only the samples of this PID (string)
+      uid            -- keep only the samples of this UID (string)
+      first          -- keep only the samples from this second on
+      last           -- keep only the samples up to this second
+      keys           -- keep only the columns of these stats keys
 
-    creates a new stats dictionary containing 18 lists with
-    the following keys: vtime, pid, tgid, uid, cpu_ticks, disp,
-    gps, wifi_snd_pkts, wifi_rcv_pkts, 3g_low, 3g_high, calling,
-    cpu_en, display_en, gps_en, wifi_en, 3g_en, total_en
+      returns a new stats dictionary with the samples that match
+      the given PID, or UID if no PID is given, in time order. Only
+      the rows of the PID (or UID), found in the rows index, are read
 
-  """
-  return {'time':[],
-          'pid':[],
-          'tgid':[],
-          'uid':[],
-          'cpu_ticks':[],
-          'disp':[],
-          'gps':[],
-          'wifi_snd_pkts':[],
-          'wifi_rcv_pkts':[],
-          '3g_low':[],
-          '3g_high':[],
-          'calling':[],
-          'cpu_en':[],
-          'display_en':[],
-          'gps_en':[],
-          'wifi_en':[],
-          '3g_en':[],
-          'total_en':[]
-         }
+    """
+    self.load()
+    keys = keys or self.stats.keys()
+    if not pid and not uid and first is None and last is None:
+      return dict((key, self.stats[key][:]) for key in keys)
+    # the rows in the time range
+    times = self.stats['time']
+    start = bisect_left(times, first) if first is not None else 0
+    end = bisect_right(times, last) if last is not None else len(times)
+    if pid or uid:
+      if pid:
+        rows = self.rows['pid'].get(pid, ())
+      else:
+        rows = self.rows['uid'].get(uid, ())
+      rows = rows[bisect_left(rows, start):bisect_left(rows, end)]
+    else:
+      rows = xrange(start, end)
+    return dict((key, _take(self.stats[key], rows)) for key in keys)
+
+  def bucket(self, size, pid=None, uid=None, first=None, last=None, keys=None,
+             per_process=False):
+    """
+      bucket(size, pid, uid, first, last, keys, per_process)
 
-def _max_size (l, title):
-  if title == "CPU TICKS":
-    cpu_ticks = '|%s|' % ' '.join(map(str, l))
-  elif title in ['CPU', 'DISPLAY', 'GPS', 'WIFI', '3G', 'TOTAL']:
-    l = [float_template % float(value) for value in l]
-  else:
-    l = [int_template % value for value in l] 
-  comb_list = l+[title]
-  return len( "%s" % max(comb_list) )
+      arguments:
+      size           -- the window size in seconds
+      per_process    -- keep the samples of each process apart
+      (the others as in select)
+
+      returns a new stats dictionary with the selected samples summed
+      up in windows of size seconds (see _bucket_stats). The windows
+      are summed up from the largest window size of the cache that
+      divides size, when the time range is made of whole windows
+
+    """
+    self.load()
+    if keys:
+      keys = set(index_keys).union(keys)
+    levels = [level for level in sorted(self.pyramid or ())
+              if size % level == 0]
+    if not levels or (first is not None and first % size) or \
+       (last is not None and (last + 1) % size):
+      return _bucket_stats(self.select(pid, uid, first, last, keys),
+                           size, per_process)
+    stats = self.pyramid[levels[-1]]
+    keys = keys or stats.keys()
+    times = stats['time']
+    rows = xrange(bisect_left(times, first) if first is not None else 0,
+                  bisect_right(times, last) if last is not None else len(times))
+    if pid or uid:
+      if pid:
+        column, value = stats['pid'], int(pid)
+      else:
+        column, value = stats['uid'], int(uid)
+      rows = [row for row in rows if column[row] == value]
+    return _bucket_stats(dict((key, [stats[key][row] for row in rows]) for key in keys),
+                         size, per_process)
+
+  def _build_pyramid(self):
+    # sum up the samples of each process in the windows of each size
+    # of the pyramid, each from the previous one. The levels read from
+    # the cache are only extended, from the window of the first second
+    # parsed again onwards
+    cached = self.pyramid
+    if cached is None or sorted(cached) != sorted(pyramid_levels):
+      cached = dict()
+      self._pyramid_start = 0
+    self.pyramid = dict()
+    stats = self.stats
+    for size in pyramid_levels:
+      level = cached.get(size)
+      if level is None:
+        level = _bucket_stats(stats, size, per_process=True)
+      else:
+        row = bisect_left(stats['time'], self._pyramid_start - self._pyramid_start % size)
+        added = _bucket_stats(dict((key, l[row:]) for key, l in stats.iteritems()),
+                              size, per_process=True)
+        for key, l in added.iteritems():
+          level[key].extend(l)
+      stats = self.pyramid[size] = level
+    self._pyramid_start = 0
 
 
 class LogStats:
@@ -157,7 +2568,11 @@ class LogStats:
     of an app extracted from the AppScope logs
   """
 
-  def __init__(self, sourcedir, verbose, quiet, pid, uid, app, grep):
+  def __init__(self, sourcedir, verbose, quiet, pid, uid, app, grep,
+               use_cache=True, stream=False, engine='auto', jobs=1,
+               first=None, last=None, out=None, format='text',
+               fixed_width=False, follow=False, mode=None, components=None,
+               level='per-app', bucket=None):
     """
       Constructor of LogStats objects
 
@@ -174,32 +2589,41 @@ class LogStats:
     self.uid = uid
     self.app = app
     self.grep = grep
+    self.stream = stream or follow
+    # keep printing the samples of the new seconds of the session
+    self.follow = follow
+    # the statistics (power, usage or all) and the components printed
+    self.mode = mode
+    self.components = components
+    # per application (UID) or per process (PID) output
+    self.level = level
+    # the size of the windows the samples are summed up in, if any
+    self.bucket = bucket
+    self.engine = engine
+    self.use_cache = use_cache
+    # where and how the results are written
+    self.out = out or sys.stdout
+    self.format = format
+    # fixed column widths: the text output needs no pre-scan
+    self.fixed_width = fixed_width
+    # the output lines not written yet
+    self._pending = list()
+
+    # the parsed AppScope capture, shared by all the actions
+    self.session = Session(sourcedir, use_cache=use_cache, jobs=jobs,
+                           first=first, last=last)
  
 
   def _get_pids (self):
     """
       _get_pids
 
-      parse usage (raw) logs and returns a list with all
-      the available PIDs followed by their UIDs
+      returns a dictionary with all the available PIDs
+      mapped to their UIDs, as found in the usage (raw) logs
 
     """
-    # try to read the usage (raw) file
-    # make a sorted lists with all the usage (raw) and power log files
-    raw_files = sorted(glob.glob('%s/[0-9]*/raw/[0-9]*' % self.sourcedir))
-    pid_dict = dict()
-    for raw_fn in raw_files:
-      with open(raw_fn) as raw_f:
-        raw_lines = raw_f.readlines()[1:]
-        for r_line in raw_lines:
-          # extract information from the usage log
-          r_line = r_line.strip()
-          # get the first column
-          PID, TGID, UID, rest = r_line.split(" ", 3)
-          # insert PID, UID mapping in the dictionary
-          if not pid_dict.has_key(PID):
-            pid_dict[PID] = UID
-    return pid_dict
+    self.session.load()
+    return dict((pid, uid) for pid, (uid, tgid) in self.session.pids.iteritems())
 
 
 
@@ -212,34 +2636,17 @@ class LogStats:
       names of those apps
 
     """
-    # try to read the packages.xml file
-    pxml_path = "%s/packages.xml" % self.sourcedir
     try:
-      xmltext = open(pxml_path).read()
+      return _read_packages(self.sourcedir, self.use_cache)
     except IOError, e:
-      print "\nNo packages.xml file found in %s.\nChange the source directory (%s -h for more information)\n" % (pxml_path, sys.argv[0])
+      if e.errno is None:
+        # the archive could not be read
+        print >> sys.stderr, "\n%s\n" % e
+        sys.exit(1)
+      pxml_path = "%s/packages.xml" % self.sourcedir
+      print >> sys.stderr, "\nNo packages.xml file found in %s.\nChange the source directory (%s -h for more information)\n" % (pxml_path, sys.argv[0])
       sys.exit(1)
 
-    root = ET.fromstring(xmltext)
-
-    # Top-level elements
-    root.findall(".")
-
-    # packages elements
-    packages = root.findall("./package")
-
-    # list of tuples
-    app_list = []
-
-    for package in packages:
-      pkg_name = package.get('name')
-      uid = package.get('userId')
-      if not uid:
-        uid = package.get('sharedUserId')
-      app_list.append( (uid, pkg_name)  )
-
-    return app_list
-
   def print_line(self, line):
     """
       print_line(line)
@@ -251,19 +2658,63 @@ class LogStats:
       line           -- the line to pe printed
 
     """
+    # if grep otpion is enable, search for the
+    # given pattern in the line
+    if self.grep:
+      # only if pattern is found, print the line
+      if self.grep.lower() not in line.lower():
+        return
+    self.print_header(line)
+
+  def print_header(self, line):
+    """
+      print_header(line)
+
+      print a line regardless of the grep pattern. The lines are
+      written in batches, except when streaming, where each line is
+      written as soon as it is ready
+
+      arguments:
+      line           -- the line to pe printed
+
+    """
+    self._pending.append(line)
+    if self.stream or len(self._pending) >= output_batch:
+      self.flush_output()
+
+  def flush_output(self):
+    """
+      flush_output
+
+      write the pending output lines
+
+    """
+    if not self._pending:
+      return
     try:
-      # if grep otpion is enable, search for the
-      # given pattern in the line
-      if self.grep:
-        # only if pattern is found, print the line
-        if self.grep.lower() in line.lower():
-          print line
-      # if no grep option given, just print the line 
-      else:
-        print line
-      if sys.stdout: sys.stdout.flush()
+      self.out.write('\n'.join(self._pending) + '\n')
+      if self.stream:
+        self.out.flush()
     except IOError:
       sys.exit(0)
+    self._pending = list()
+
+  def print_records(self, keys, records):
+    """
+      print_records(keys, records)
+
+      print the records in the machine-readable output format,
+      preceded by a header with the field names (for CSV and TSV)
+
+      arguments:
+      keys           -- the names of the fields
+      records        -- an iterable of the field values of each record
+
+    """
+    if self.format != 'jsonl':
+      self.print_header(_format_record(keys, keys, self.format))
+    for record in records:
+      self.print_line(_format_record(keys, record, self.format))
 
 
 
@@ -280,14 +2731,9 @@ class LogStats:
     # explicitly add the system UID
     app_dict['0']='system'
 
-    uids, names = zip(*app_list)
-    # find max size of pacjage names
-    max_name = len( "%s" % max(names, key=len) )
-    # find the max size of uids 
-    max_uid = len( "%s" % max(uids) )
-    # find the max size of pids
+    # only the PID index is needed
+    self.session.project([])
     pids = self._get_pids()
-    max_pid = len("%s" % max(pids))
     pids_sorted = sorted(int(pid) for pid in pids.keys())
     data = list()
     for pid in pids_sorted:
@@ -303,22 +2749,412 @@ class LogStats:
         app = '?'
       data.append((pid, uid, app))
 
-    # template for print formatting based on the max fields' values
+    if self.format != 'text':
+      if not self.quiet:
+        self.print_records(['pid', 'uid', 'app'],
+                           [(int(pid), int(uid), app) for pid, uid, app in data])
+      else:
+        self.print_records(['uid', 'app'], [(int(uid), app) for pid, uid, app in data])
+      return
+
     # non quite mode: print pid, uid and app package name
     if not self.quiet:
-      template = "{0:%d}\t{1:%d}\t{2:%d}" % (max_pid, max_uid, max_name)
-      print template.format("PID", "UID", "APP PACKAGE")
-      for app in data:
-        pid, uid, pname = app
-        output_line =  template.format(pid, uid, pname)
-        self.print_line(output_line)
+      self.print_table(["PID", "UID", "APP PACKAGE"], data)
     else: # quiet mode: print only uid and app package name
-      template = "{0:%d}\t{1:%d}" % (max_uid, max_name)
-      print template.format("UID", "APP PACKAGE")
-      for app in data:
-        pid, uid, pname = app
-        output_line = template.format(uid, pname)
-        self.print_line(output_line)
+      self.print_table(["UID", "APP PACKAGE"], [(uid, pname) for pid, uid, pname in data])
+
+
+  def print_apps_report (self):
+    """
+      print_apps_report
+
+      print out the energy consumed by every monitored app (UID),
+      computed in a single pass over the samples of the session: the
+      per-component totals of each app, sorted by the total energy,
+      and, in verbose mode, the per-second series of each app
+
+    """
+    app_dict = dict(self._parse_packages_xml())
+    # explicitly add the system UID
+    app_dict['0'] = 'system'
+
+    self.session.project(power_keys)
+    stats = self.session.load().stats
+    timings.count('rows kept', len(stats['time']))
+    if self.level == 'per-proc':
+      self.print_rollup(stats)
+      return
+    totals, pids, series = _aggregate_apps(stats, self.verbose)
+
+    if not totals:
+      print >> sys.stderr, "\n No samples found in AppScope log files.\n\n"
+      sys.exit(1)
+
+    # most energy consuming apps first
+    uids = sorted(totals, key=lambda uid: totals[uid][-1], reverse=True)
+
+    if self.format != 'text':
+      if self.verbose:
+        self.print_records(['uid', 'app', 'time'] + power_keys,
+                           ([uid, app_dict.get(str(uid), '?'), time] + energies
+                            for uid in uids
+                            for time, energies in sorted(series[uid].iteritems())))
+      elif not self.quiet:
+        self.print_records(['uid', 'app', 'pids'] + power_keys,
+                           ([uid, app_dict.get(str(uid), '?'), len(pids[uid])] + totals[uid]
+                            for uid in uids))
+      else:
+        self.print_records(['uid', 'app', 'total_en'],
+                           ([uid, app_dict.get(str(uid), '?'), totals[uid][-1]]
+                            for uid in uids))
+      return
+    data = list()
+    for uid in uids:
+      app = app_dict.get(str(uid), '?')
+      data.append([int_template % uid, app, int_template % len(pids[uid])] +
+                  [float_template % energy for energy in totals[uid]])
+
+    if not self.quiet:
+      titles = ['UID', 'APP PACKAGE', 'PIDS', 'CPU', 'DISPLAY', 'GPS', 'WIFI', '3G', 'TOTAL']
+    else:
+      titles = ['UID', 'APP PACKAGE', 'TOTAL']
+      data = [[row[0], row[1], row[-1]] for row in data]
+    self.print_table(titles, data)
+
+    if self.verbose:
+      # the per-second series of each app
+      titles = ['TIME', 'CPU', 'DISPLAY', 'GPS', 'WIFI', '3G', 'TOTAL']
+      for uid in uids:
+        data = [[int_template % time] + [float_template % energy for energy in energies]
+                for time, energies in sorted(series[uid].iteritems())]
+        self.print_header("\n%s (UID: %s)" % (_bold(app_dict.get(str(uid), '?')), uid))
+        self.print_table(titles, data)
+
+
+  def print_rollup (self, stats):
+    """
+      print_rollup (stats)
+
+      arguments:
+      stats          -- the stats dictionary of the samples
+
+      print out the energy consumed by every process (PID), thread
+      group (TGID), app (UID) and shared user, as a tree with the most
+      energy consuming first at each level. The totals of the
+      processes, thread groups and apps are summed up in a single pass
+      over the samples and the ones of the shared users from the
+      totals of their apps
+
+    """
+    app_dict = dict(self._parse_packages_xml())
+    # explicitly add the system UID
+    app_dict['0'] = 'system'
+    shared_users = dict(_read_shared_users(self.sourcedir, self.use_cache))
+
+    totals = _rollup_processes(stats)
+    if not totals['uid']:
+      print >> sys.stderr, "\n No samples found in AppScope log files.\n\n"
+      sys.exit(1)
+    # the children of each thread group and app (their keys start
+    # with the key of their parent)
+    children = {'tgid': dict(), 'uid': dict()}
+    for key in totals['pid']:
+      children['tgid'].setdefault(key[:2], []).append(key)
+    for key in totals['tgid']:
+      children['uid'].setdefault(key[0], []).append(key)
+    # the apps of each shared user (or the app itself, if it has none)
+    groups = dict()
+    for uid in totals['uid']:
+      name = shared_users.get(str(uid))
+      groups.setdefault(name and ('shared-user', name) or ('uid', uid), []).append(uid)
+    group_totals = dict()
+    for group, uids in groups.iteritems():
+      group_totals[group] = [sum(energies) for energies
+                             in zip(*[totals['uid'][uid] for uid in uids])]
+
+    def heaviest(keys, level_totals):
+      # most energy consuming first
+      return sorted(keys, key=lambda key: level_totals[key][-1], reverse=True)
+
+    # (depth, level, ID, parent ID, name, totals) of each line
+    data = list()
+    for group in heaviest(groups, group_totals):
+      level, name = group
+      depth = 0
+      if level == 'shared-user':
+        data.append((0, level, name, '', name, group_totals[group]))
+        depth = 1
+      for uid in heaviest(groups[group], totals['uid']):
+        app = app_dict.get(str(uid), '?')
+        data.append((depth, 'uid', uid, name if depth else '', app, totals['uid'][uid]))
+        for tgid_key in heaviest(children['uid'][uid], totals['tgid']):
+          tgid = tgid_key[1]
+          data.append((depth + 1, 'tgid', tgid, uid, app, totals['tgid'][tgid_key]))
+          for pid_key in heaviest(children['tgid'][tgid_key], totals['pid']):
+            data.append((depth + 2, 'pid', pid_key[2], tgid, app,
+                         totals['pid'][pid_key]))
+
+    if self.format != 'text':
+      if not self.quiet:
+        self.print_records(['level', 'id', 'parent', 'app'] + power_keys,
+                           ([level, key, parent, app] + energies
+                            for depth, level, key, parent, app, energies in data))
+      else:
+        self.print_records(['level', 'id', 'parent', 'app', 'total_en'],
+                           ([level, key, parent, app, energies[-1]]
+                            for depth, level, key, parent, app, energies in data))
+      return
+    rows = [['  ' * depth + level, str(key), app] +
+            [float_template % energy for energy in energies]
+            for depth, level, key, parent, app, energies in data]
+    if not self.quiet:
+      self.print_table(['LEVEL', 'ID', 'APP PACKAGE', 'CPU', 'DISPLAY', 'GPS',
+                        'WIFI', '3G', 'TOTAL'], rows)
+    else:
+      self.print_table(['LEVEL', 'ID', 'APP PACKAGE', 'TOTAL'],
+                       [row[:3] + row[-1:] for row in rows])
+
+  def print_summary (self):
+    """
+      print_summary
+
+      print out a summary of the energy consumed by every monitored
+      app (or only by the selected process or app): the total energy
+      of each component, the mean and peak power and the 50th, 95th
+      and 99th percentiles of the power. The samples are summed up
+      while they are read, without keeping them: from the cache when it
+      is up to date, otherwise (and with --stream) while the logs are
+      parsed, so that no samples table is built
+
+    """
+    self.session.project(power_keys)
+    self.session.restrict(self.pid, self.uid)
+    if not self.stream and self.session.load(parse=False) is None:
+      self.stream = True
+    if self.pid or self.uid or self.app:
+      self.check_app_input()
+    app_dict = dict(self._parse_packages_xml())
+    # explicitly add the system UID
+    app_dict['0'] = 'system'
+
+    indexes = [stats_keys.index(key) for key in ['time', 'uid'] + power_keys]
+    if self.stream:
+      samples = (itemgetter(*indexes)(sample) for sample
+                 in self.session.iter_samples(pid=self.pid, uid=self.uid))
+    else:
+      stats = self.session.load().stats
+      columns = [stats[key] for key in ['time', 'uid'] + power_keys]
+      if self.pid:
+        rows = self.session.rows['pid'].get(self.pid, ())
+      elif self.uid:
+        rows = self.session.rows['uid'].get(self.uid, ())
+      else:
+        rows = xrange(len(stats['time']))
+      samples = (tuple(column[row] for column in columns) for row in rows)
+
+    # UID -> its summary
+    summaries = dict()
+    with timings.phase('summarize'):
+      for sample in samples:
+        uid = sample[1]
+        if uid not in summaries:
+          summaries[uid] = Summary()
+        summaries[uid].add(sample[0], sample[2:])
+    if not summaries:
+      print >> sys.stderr, "\n No samples found in AppScope log files.\n\n"
+      sys.exit(1)
+
+    # most energy consuming apps first
+    data = list()
+    for uid, summary in summaries.iteritems():
+      summary.close()
+      data.append([uid, app_dict.get(str(uid), '?'), summary.seconds] +
+                  summary.totals +
+                  [summary.mean(), summary.peak, summary.percentile(50),
+                   summary.percentile(95), summary.percentile(99)])
+    data.sort(key=lambda row: row[8], reverse=True)
+
+    keys = ['uid', 'app', 'seconds'] + power_keys + \
+           ['mean_power', 'peak_power', 'p50_power', 'p95_power', 'p99_power']
+    titles = ['UID', 'APP PACKAGE', 'SECONDS', 'CPU', 'DISPLAY', 'GPS', 'WIFI',
+              '3G', 'TOTAL', 'MEAN', 'PEAK', 'P50', 'P95', 'P99']
+    if self.quiet:
+      # only the totals and the power of the apps
+      kept = [0, 1, 8, 9, 10, 13]
+      keys = [keys[i] for i in kept]
+      titles = [titles[i] for i in kept]
+      data = [[row[i] for i in kept] for row in data]
+    if self.format != 'text':
+      self.print_records(keys, data)
+      return
+    self.print_table(titles,
+                     [[int_template % row[0], row[1]] +
+                      [float_template % value if isinstance(value, float) else int_template % value
+                       for value in row[2:]]
+                      for row in data])
+
+
+  def print_devices_report (self, sourcedirs, jobs=1):
+    """
+      print_devices_report (sourcedirs, jobs=1)
+
+      arguments:
+      sourcedirs     -- the source directories of the device captures
+      jobs           -- the number of devices analyzed concurrently
+
+      print out the energy consumed by every monitored app of several
+      devices, each with the package names of its own packages.xml:
+      the per-component totals of each (device, app) pair and, at the
+      end, the totals of each device
+
+    """
+    tasks = [(sourcedir, self.session.use_cache, self.session.first, self.session.last)
+             for sourcedir in sourcedirs]
+    if jobs > 1 and len(tasks) > 1:
+      import multiprocessing
+      pool = multiprocessing.Pool(min(jobs, len(tasks)))
+      try:
+        with timings.phase('devices (parallel)'):
+          results = pool.map(_report_device, tasks)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = map(_report_device, tasks)
+
+    # most energy consuming apps first, in the order of the devices
+    data = list()
+    device_totals = list()
+    errors = ParseErrors()
+    for sourcedir, apps, totals, pids, device_errors in results:
+      errors.merge(device_errors)
+      device = os.path.normpath(sourcedir)
+      for uid in sorted(totals, key=lambda uid: totals[uid][-1], reverse=True):
+        data.append([device, uid, apps[uid], pids[uid]] + totals[uid])
+      device_energies = [0] * len(power_keys)
+      for app_totals in totals.itervalues():
+        for i, energy in enumerate(app_totals):
+          device_energies[i] += energy
+      device_totals.append([device, len(totals), sum(pids.itervalues())] + device_energies)
+    parse_errors.clear()
+    parse_errors.merge(errors.state())
+    if not data:
+      print >> sys.stderr, "\n No samples found in AppScope log files.\n\n"
+      sys.exit(1)
+
+    if self.format != 'text':
+      if not self.quiet:
+        self.print_records(['device', 'uid', 'app', 'pids'] + power_keys, data)
+      else:
+        self.print_records(['device', 'uid', 'app', 'total_en'],
+                           ([row[0], row[1], row[2], row[-1]] for row in data))
+      return
+    energy_titles = ['CPU', 'DISPLAY', 'GPS', 'WIFI', '3G', 'TOTAL']
+    rows = [[row[0], int_template % row[1], row[2], int_template % row[3]] +
+            [float_template % energy for energy in row[4:]] for row in data]
+    if not self.quiet:
+      self.print_table(['DEVICE', 'UID', 'APP PACKAGE', 'PIDS'] + energy_titles, rows)
+    else:
+      self.print_table(['DEVICE', 'UID', 'APP PACKAGE', 'TOTAL'],
+                       [[row[0], row[1], row[2], row[-1]] for row in rows])
+
+    if not self.quiet:
+      rows = [[row[0], int_template % row[1], int_template % row[2]] +
+              [float_template % energy for energy in row[3:]] for row in device_totals]
+      self.print_header("")
+      self.print_table(['DEVICE', 'APPS', 'PIDS'] + energy_titles, rows)
+
+
+  def export_session (self, path, format):
+    """
+      export_session (path, format)
+
+      arguments:
+      path           -- the file to write the session to
+      format         -- 'parquet' or 'arrow' (Arrow IPC file format)
+
+      export all the samples of the session, with their 18 fields, the
+      cpu ticks as a fixed-size list column and the app package name of
+      each sample, to a Parquet or Arrow IPC file (requires pyarrow).
+      The samples are sorted by time and split in row groups (record
+      batches) of whole seconds, export_window seconds each, so that
+      time ranges can be read selectively. The UID to app package name
+      mapping is also kept in the schema metadata. pyarrow versions that
+      cannot write fixed-size lists to Parquet get a list column instead
+
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    app_dict = dict(self._parse_packages_xml())
+    # explicitly add the system UID
+    app_dict['0'] = 'system'
+
+    stats = self.session.load().stats
+    widths = set(len(ticks) for ticks in stats['cpu_ticks'])
+    if len(widths) > 1:
+      print >> sys.stderr, "\n The CPU ticks of the samples have different lengths, cannot export them.\n\n"
+      sys.exit(1)
+    width = widths and widths.pop() or 0
+
+    # the app package name of each sample (Parquet dictionary
+    # encodes it on its own)
+    apps = [app_dict.get(str(uid), '?') for uid in stats['uid']]
+    metadata = {'appscope.apps': json.dumps(app_dict, sort_keys=True),
+                'appscope.cpu_ticks_width': str(width)}
+
+    def window_table(start, end, fixed_size=True):
+      # the table of the samples in [start, end)
+      arrays = list()
+      for key in stats_keys:
+        column = stats[key][start:end]
+        if key == 'cpu_ticks':
+          ticks = pyarrow.array([tick for ticks in column for tick in ticks],
+                                type=pyarrow.int64())
+          if fixed_size:
+            arrays.append(pyarrow.FixedSizeListArray.from_arrays(ticks, width))
+          else:
+            offsets = pyarrow.array([row * width for row in xrange(len(column) + 1)],
+                                    type=pyarrow.int32())
+            arrays.append(pyarrow.ListArray.from_arrays(offsets, ticks))
+        elif key in power_keys:
+          arrays.append(pyarrow.array(column, type=pyarrow.float64()))
+        else:
+          arrays.append(pyarrow.array(column, type=pyarrow.int64()))
+      arrays.append(pyarrow.array(apps[start:end], type=pyarrow.string()))
+      table = pyarrow.Table.from_arrays(arrays, names=stats_keys + ['app'])
+      return table.replace_schema_metadata(metadata)
+
+    # one row group (record batch) for each window of export_window seconds
+    times = stats['time']
+    windows = list()
+    start = 0
+    while start < len(times):
+      end = bisect_left(times, (times[start] // export_window + 1) * export_window, start)
+      windows.append((start, end))
+      start = end
+
+    # a fixed-size list cannot be empty: without cpu ticks (e.g. no
+    # samples at all) a list column is written instead
+    fixed_size = width > 0
+    schema = window_table(0, 0, fixed_size).schema
+    if format == 'parquet':
+      try:
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+      except pyarrow.ArrowNotImplementedError:
+        # older pyarrow versions cannot write fixed-size lists to
+        # Parquet: fall back to a (variable size) list column
+        fixed_size = False
+        schema = window_table(0, 0, fixed_size).schema
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    else:
+      writer = pyarrow.RecordBatchFileWriter(path, schema)
+    try:
+      # an empty session is written as one empty batch
+      for start, end in windows or [(0, 0)]:
+        writer.write_table(window_table(start, end, fixed_size))
+    finally:
+      writer.close()
 
 
   def check_app_input(self):
@@ -336,15 +3172,19 @@ class LogStats:
     app_dict = {}
     for uid, name in app_list:
       app_dict[name] = uid
-    # create a dict with all the PIDs and the corresponding
-    # UIDs
-    pid_dict = self._get_pids()
+    if self.pid and self.stream:
+      # the PID is looked up while the logs are streamed,
+      # no need to scan them in advance
+      return
 
     if self.pid:
+      # create a dict with all the PIDs and the corresponding
+      # UIDs
+      pid_dict = self._get_pids()
       try:
         self.uid = pid_dict[self.pid]
       except:
-        print "\n PID: %s not found in AppScope log files.\n\n" % self.pid
+        print >> sys.stderr, "\n PID: %s not found in AppScope log files.\n\n" % self.pid
         sys.exit(1)
       uid_to_app = dict((uid, name) for name, uid in app_dict.iteritems())
       try:
@@ -354,14 +3194,14 @@ class LogStats:
         self.app = '?'
     elif self.uid:
       if not self.uid in app_dict.values():
-        print "\n UID: %s not found in AppScope log files.\n\n" % self.uid
+        print >> sys.stderr, "\n UID: %s not found in AppScope log files.\n\n" % self.uid
         sys.exit(1)
       # set only app package name, skip PID
       # to show power at application level
       try:
         uid_to_app = dict((uid, name) for name, uid in app_dict.iteritems())
       except:
-        print "\n UID: %s not found in AppScope log files.\n\n" % self.uid
+        print >> sys.stderr, "\n UID: %s not found in AppScope log files.\n\n" % self.uid
         sys.exit(1)
       self.app = uid_to_app[self.uid]
 
@@ -371,102 +3211,160 @@ class LogStats:
       try:
         self.uid = app_dict[self.app]
       except:
-        print "\n App package name: %s not found in AppScope log files.\n\n" % self.app
+        print >> sys.stderr, "\n App package name: %s not found in AppScope log files.\n\n" % self.app
         sys.exit(1)
-      print self.pid, self.uid, self.app
 
 
 
 
-  def print_stats(self):
+  def print_stats(self, columns=None):
     """
-      print_stats
+      print_stats(columns)
 
      print the statistics dicitonary formatted and at the
      chosen level
 
+      arguments:
+      columns        -- the (key, title) pairs of the columns to be
+                        printed, instead of the ones of the level
+
     """
-    # iterate the sorted list of timestamps
-    timestamps = sorted(self.stats['time'])
-    first = timestamps[0]
-    last = timestamps[len(timestamps)-1]
-
-    max_time = _max_size( self.stats['time'], 'TIME')
-    max_pid = _max_size( self.stats['pid'], 'PID' )
-    max_tgid = _max_size( self.stats['tgid'], 'TGID' )
-    max_uid = _max_size( self.stats['uid'], 'UID' )
-    cpu_ticks_str = ['|%s|'  % ' '.join( map(str, elem) ) for elem in self.stats['cpu_ticks']]
-    max_cpu_ticks = _max_size( cpu_ticks_str, 'CPU TICKS' )
-    max_disp = _max_size( self.stats['disp'], 'DISPLAY (US)' )
-    max_gps = _max_size( self.stats['gps'], 'GPS (US)' )
-    max_wifi_snd_pkts = _max_size( self.stats['wifi_snd_pkts'], 'WIFI SND PKTS' )
-    max_wifi_rcv_pkts = _max_size( self.stats['wifi_rcv_pkts'], 'WIFI RCV PKTS' )
-    max_g3_low = _max_size( self.stats['3g_low'], '3G LOW' )
-    max_g3_high = _max_size( self.stats['3g_high'], '3G HIGH' )
-    max_calling = _max_size( self.stats['calling'], 'CALLING' )
-    max_cpu_en = _max_size( self.stats['cpu_en'], 'CPU' )
-    max_display_en = _max_size( self.stats['display_en'], 'DISPLAY' )
-    max_gps_en = _max_size( self.stats['gps_en'], 'GPS')
-    max_wifi_en = _max_size( self.stats['wifi_en'], 'WIFI' )
-    max_g3_en = _max_size( self.stats['3g_en'], '3G' )
-    max_total_en = _max_size( self.stats['total_en'], 'TOTAL' )
+    columns = columns or self._columns()
+    keys = [key for key, title in columns]
+    if self.format != 'text':
+      self.print_records(keys, zip(*[self.stats[key] for key in keys]))
+      return
+
+    titles = [title for key, title in columns]
+    if self.fixed_width:
+      # no pre-scan: print each row as soon as it is formatted
+      widths = [_stream_width(key, title) for key, title in columns]
+      rows = ([_format_value(key, value) for key, value in zip(keys, row)]
+              for row in zip(*[self.stats[key] for key in keys]))
+      self.print_table(titles, rows, widths)
+      return
+
+    # format each cell once, column by column, and keep the
+    # cells to find the column widths and print the rows
+    cells = [[_format_value(key, value) for value in self.stats[key]]
+             for key, title in columns]
+    widths = [max([len(title)] + map(len, column))
+              for (key, title), column in zip(columns, cells)]
+    self.print_table(titles, zip(*cells), widths)
+
+  def print_table(self, titles, rows, widths=None):
+    """
+      print_table(titles, rows, widths)
+
+      print a table of tab separated columns, padded to the given
+      widths. If no widths are given, the widths of the titles and
+      the (already formatted) cells of the rows are used
 
+      arguments:
+      titles         -- the titles of the columns
+      rows           -- an iterable of lists of formatted cells
+      widths         -- the widths of the columns
+
+    """
+    if widths is None:
+      rows = list(rows)
+      widths = [max(map(len, column)) for column in zip(titles, *rows)]
+    template = '\t'.join('{%d:%d}' % (i, width) for i, width in enumerate(widths))
+    self.print_header(template.format(*titles))
+    for row in rows:
+      self.print_line(template.format(*row))
+
+  def _columns(self):
+    # the (key, title) pairs of the columns to be printed: the ones of
+    # the mode (or of the level, for power) and of the components
+    if self.mode == 'usage':
+      columns = output_columns['usage']
+    elif self.mode == 'all':
+      columns = output_columns['verbose']
+    elif self.mode == 'power' or self.components:
+      # the components of the quiet level would be left out
+      if self.quiet and not self.components:
+        columns = output_columns['quiet']
+      elif self.verbose and not self.mode:
+        columns = output_columns['verbose']
+      else:
+        columns = output_columns['default']
+    else:
+      columns = output_columns[self._output_mode()]
+    columns = _select_columns(columns, self.components)
+    if self.level == 'per-proc':
+      # one row per process and second
+      columns = columns[:1] + [('pid', 'PID'), ('tgid', 'TGID')] + columns[1:]
+    return columns
+
+  def _output_mode(self):
     if not self.quiet and not self.verbose:
-      template = "{0:%d}\t{1:%d}\t{2:%d}\t{3:%d}\t{4:%d}\t{5:%d}\t{6:%d}" % (\
-      max_time, max_cpu_en, max_display_en, max_gps_en, max_wifi_en, max_g3_en, max_total_en)
-      print template.format('TIME', 'CPU', 'DISPLAY', 'GPS', 'WIFI', '3G', 'TOTAL')
+      return 'default'
     elif self.quiet:
-      template = "{0:%d}\t{1:%d}" % (max_time, max_total_en)
-      print template.format('TIME', 'TOTAL POWER CONSUMPTION')
-    elif self.verbose:
-      template = "{0:%d}\t{1:%d}\t{2:%d}\t{3:%d}\t{4:%d}\t{5:%d}\t{6:%d}\t{7:%d}\t{8:%d}\t{9:%d}\t{10:%d}\t{11:%d}\t{12:%d}\t{13:%d}\t{14:%d}" % (\
-      max_time, max_cpu_ticks, max_disp, max_gps, max_wifi_snd_pkts, max_wifi_rcv_pkts,\
-      max_g3_low, max_g3_high, max_calling, \
-      max_cpu_en, max_display_en, max_gps_en, max_wifi_en, max_g3_en, max_total_en)
-      print template.format('TIME', 'CPU TICKS', 'DISPLAY (US)', 'GPS (US)', 'WIFI SND PKTS', \
-      'WIFI RCV PKTS', '3G LOW', '3G HIGH', 'CALLING', \
-      'CPU', 'DISPLAY', 'GPS', 'WIFI', '3G', 'TOTAL')
-     
-
-
-
-    for index in range( len(self.stats['time']) ):
-      # extract values
-      time = int_template % self.stats['time'][index]
-      pid = int_template % self.stats['pid'][index]
-      tgid = int_template % self.stats['tgid'][index]
-      uid =  int_template % self.stats['uid'][index]
-      cpu_ticks = self.stats['cpu_ticks'][index]
-      cpu_ticks = '|%s|' % ' '.join(map(str, cpu_ticks))
-      disp = int_template % self.stats['disp'][index]
-      gps = int_template % self.stats['gps'][index]
-      wifi_snd_pkts = int_template % self.stats['wifi_snd_pkts'][index]
-      wifi_rcv_pkts = int_template % self.stats['wifi_rcv_pkts'][index]
-      g3_low = int_template % self.stats['3g_low'][index]
-      g3_high = int_template % self.stats['3g_high'][index]
-      calling = int_template % self.stats['calling'][index]
-      cpu_en = float_template % self.stats['cpu_en'][index]
-      display_en = float_template % self.stats['display_en'][index]
-      gps_en = float_template % self.stats['gps_en'][index]
-      wifi_en = float_template % self.stats['wifi_en'][index]
-      g3_en = float_template % self.stats['3g_en'][index]
-      total_en = float_template % self.stats['total_en'][index]
-
-
-      if not self.quiet and not self.verbose:
-        line = template.format(time, cpu_en, display_en, gps_en, wifi_en, g3_en, total_en)
-        self.print_line(line)
-      elif self.quiet:
-        line = template.format(time, total_en)
-        self.print_line(line)
-      elif self.verbose: 
-        line = template.format(time, cpu_ticks, disp, gps, wifi_snd_pkts, wifi_rcv_pkts, \
-        g3_low, g3_high, calling, cpu_en, display_en, gps_en, wifi_en, g3_en, total_en)
-        self.print_line(line)
+      return 'quiet'
+    else:
+      return 'verbose'
 
+  def print_stream(self):
+    """
+      print_stream
+
+      print the samples of the selected process or application while
+      the log files are parsed, combining them per second. The memory
+      used does not grow with the trace length and the output starts
+      as soon as the first second is parsed, at the cost of fixed
+      column widths
+
+    """
+    columns = self._columns()
+    self.session.project(key for key, title in columns)
+    self.check_app_input()
 
+    indexes = [stats_keys.index(key) for key, title in columns]
+    if self.level == 'per-proc':
+      # the samples of each process are printed as they are
+      combine = iter
+    elif self.bucket:
+      # summed up in windows of the given size
+      size = self.bucket
+      combine = lambda samples: _iter_combined_samples(
+        (sample[0] - sample[0] % size,) + sample[1:] for sample in samples)
+    else:
+      combine = _iter_combined_samples
+    if self.follow:
+      # combine the samples of each second as soon as it is parsed
+      samples = (sample for second_samples
+                 in self.session.follow_seconds(pid=self.pid, uid=self.uid)
+                 for sample in combine(second_samples))
+    else:
+      samples = combine(self.session.iter_samples(pid=self.pid, uid=self.uid))
+    self.found = False
 
+    try:
+      if self.format != 'text':
+        self.print_records([key for key, title in columns],
+                           ([sample[index] for index in indexes]
+                            for sample in self._found(samples)))
+      else:
+        self.print_table([title for key, title in columns],
+                         ([_format_value(key, sample[index])
+                           for (key, title), index in zip(columns, indexes)]
+                          for sample in self._found(samples)),
+                         [_stream_width(key, title) for key, title in columns])
+    except KeyboardInterrupt:
+      if not self.follow:
+        raise
+      # stop following the session
+      return
+    if self.pid and not self.found:
+      print >> sys.stderr, "\n PID: %s not found in AppScope log files.\n\n" % self.pid
+      sys.exit(1)
 
+  def _found(self, samples):
+    # pass the samples through, noting if there was any
+    for sample in samples:
+      self.found = True
+      yield sample
 
   def print_results (self):
     """
@@ -477,82 +3375,254 @@ class LogStats:
       files
 
     """
+    # parse only the columns to be printed (and the power ones, for
+    # the totals of the processes)
+    keys = [key for key, title in self._columns()]
+    if self.level == 'per-proc':
+      keys += power_keys
+    self.session.project(keys)
+    # decode only the samples of the process (or app): a PID is looked
+    # up in the session, the UID of an app package name is not
+    self.session.restrict(self.pid, self.uid)
     # check if the input arguments for app specification
     # are the expected ones
     self.check_app_input()
+    self.session.restrict(self.pid, self.uid)
  
-    # make a sorted lists with all the usage (raw) and power log files
-    raw_files = glob.glob('%s/[0-9]*/raw/[0-9]*' % self.sourcedir)
-    power_files = glob.glob('%s/[0-9]*/power/[0-9]*.log' % self.sourcedir)
-    #raw_files.sort()
-    raw_files = sorted(raw_files, key=lambda x: int(x.rsplit('/', 1)[1]))
-    power_files = sorted(power_files, key=lambda x: int(x.rsplit('/', 1)[1].split('.log')[0]))
-
-    # iterate the two files  simultaneously
-    for raw_fn, power_fn in zip(raw_files, power_files):
-      with open(raw_fn) as raw_f, open(power_fn) as power_f:
-        raw_lines = raw_f.readlines()[1:]
-        lines_size = len(raw_lines)
-        #power_lines = power_f.readlines()[0:lines_size]
-        power_lines = power_f.readlines()[0:-1]
-
-        for r_line, p_line in zip(raw_lines, power_lines):
-          second = int(raw_fn.rsplit('/',1)[1])
-          # extract information from the usage log
-          r_line = r_line.strip()
-          raw_values = r_line.split(" ", 11)
-          # remove the last element from the list
-          del raw_values[-1]
-          ##raw_values = [int(value) for value in raw_values]
-          PID, TGID, UID, CPU_TICKS_REST = r_line.split(" ", 3)
-          
-          # get CPU ticks per different frequencies
-          cpu_ticks_freq = CPU_TICKS_REST.split(" ", 12)
-          REST = cpu_ticks_freq.pop()
-          disp, gps, wifi_snd_pkts, wifi_rcv_pkts, g3_low,\
-          g3_high, calling = REST.split()
-          # extract information from the power log
-          p_line = p_line.strip()
-          values = p_line.split()
-          # transform all values to floating points
-          values = [float(value.strip()) for value in values]
-          CPU_en, DISP_en, GPS_en, WIFI_en, G3_en = values
-          # if we want the results at process level
-          if self.pid:
-            # if the pid read from the file is different from the one provided
-            # in the console skip this entry
-            if str(PID) != self.pid: continue
-          # if we want the results at application level
-          elif self.uid:
-            # if the uid read from the file is different from the one provided
-            # in the console skip this entry
-            if str(UID) != self.uid: continue
-          # compute the total energy
-          total_en = float(CPU_en) + float(DISP_en) + float(GPS_en) + float(WIFI_en) + float(G3_en)
-          self.stats['time'].append(int(second))
-          self.stats['pid'].append(int(PID))
-          self.stats['tgid'].append(int(TGID))
-          self.stats['uid'].append(int(UID))
-					# tranform the cpu ticks to a list of integers
-          cpu_ticks_freq = map(int, cpu_ticks_freq)
-          self.stats['cpu_ticks'].append(cpu_ticks_freq)
-          self.stats['disp'].append(int(disp))
-          self.stats['gps'].append(int(gps))
-          self.stats['wifi_snd_pkts'].append(int(wifi_snd_pkts))
-          self.stats['wifi_rcv_pkts'].append(int(wifi_rcv_pkts))
-          self.stats['3g_low'].append(int(g3_low))
-          self.stats['3g_high'].append(int(g3_high))
-          self.stats['calling'].append(int(calling))
-          self.stats['cpu_en'].append(CPU_en)
-          self.stats['display_en'].append(DISP_en)
-          self.stats['gps_en'].append(GPS_en)
-          self.stats['wifi_en'].append(WIFI_en)
-          self.stats['3g_en'].append(G3_en)
-          self.stats['total_en'].append(total_en)
+    self.session.load()
+    # keep only the samples of the selected process or application
+    if self.bucket:
+      # summed up in windows of the given size
+      with timings.phase('bucket'):
+        self.stats = self.session.bucket(self.bucket, pid=self.pid, uid=self.uid,
+                                         per_process=self.level == 'per-proc')
+    else:
+      with timings.phase('select'):
+        self.stats = self.session.select(pid=self.pid, uid=self.uid)
+    timings.count('rows kept', len(self.stats['time']))
+    if not self.stats['time']:
+      # e.g. a time range without samples of the process (or app)
+      print >> sys.stderr, "\n No samples found in AppScope log files.\n\n"
+      sys.exit(1)
+    if self.level == 'per-proc':
+      # the samples of each process, followed by the totals of each
+      # process, thread group and app
+      with timings.phase('print'):
+        self.print_stats()
+        if self.format == 'text':
+          self.print_header("")
+          self.print_rollup(self.stats)
+      return
     # combine samples with the same timestamp
-    self.stats = _combine_duplicate_time_samples (self.stats, key='time')
+    with timings.phase('combine'):
+      if self.engine == 'numpy' or (self.engine == 'auto' and numpy):
+        self.stats = _combine_duplicate_time_samples_numpy (self.stats)
+      else:
+        self.stats = _combine_duplicate_time_samples (self.stats, key='time')
     # print the statistics formatted
-    self.print_stats()
+    with timings.phase('print'):
+      self.print_stats()
+
+
+class QueryError(Exception):
+  """
+    QueryError (class)
+
+    A query of the server that cannot be answered, with the HTTP
+    status of the response
+  """
+
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+
+
+class SessionCache:
+  """
+    SessionCache (class)
+
+    The sessions loaded by the query server, kept in memory in least
+    recently used order. When more than size sessions are loaded, the
+    least recently used one is dropped, so the memory used stays
+    bounded however many sessions are queried
+  """
+
+  def __init__(self, size, use_cache=True, jobs=1):
+    self.size = size
+    self.use_cache = use_cache
+    self.jobs = jobs
+    # source directory -> (session, UID -> app package name)
+    self.sessions = OrderedDict()
+
+  def get(self, sourcedir):
+    """
+      get(sourcedir)
+
+      arguments:
+      sourcedir      -- the directory containing the packages.xml file
+
+      returns the loaded session of the given directory and the app
+      package names of its UIDs, loading them if they are not in
+      memory. raises IOError if there is no packages.xml file
+
+    """
+    sourcedir = os.path.normpath(sourcedir)
+    entry = self.sessions.pop(sourcedir, None)
+    if entry is None:
+      apps = dict(_read_packages(sourcedir, self.use_cache))
+      # explicitly add the system UID
+      apps['0'] = 'system'
+      session = Session(sourcedir, use_cache=self.use_cache, jobs=self.jobs)
+      entry = (session.load(), apps)
+      # the malformed lines of each session, as it is loaded
+      parse_errors.report()
+      parse_errors.clear()
+    self.sessions[sourcedir] = entry
+    while len(self.sessions) > self.size:
+      self.sessions.popitem(last=False)
+    return entry
+
+
+def _query (sessions, path, params, sourcedirs, format):
+  """
+    _query (sessions, path, params, sourcedirs, format)
+
+    arguments:
+    sessions             -- the SessionCache of the server
+    path                 -- '/apps' or '/samples'
+    params               -- the parameters of the query (a dictionary)
+    sourcedirs           -- the source directories served (the first one
+                            if no 'dir' is given)
+    format               -- the output format, if no 'format' is given
+
+    answer a query of the server: the list of the monitored apps
+    (/apps) or the samples of a process or app (/samples, with pid,
+    uid or app), optionally in a time range (from, to) and only for
+    some components (component, comma separated) and summed up in
+    windows (bucket, e.g. 5m). returns the output formatted as the
+    command-line tool prints it. Only the source directories given
+    to the server can be queried
+
+  """
+  sourcedir = params.get('dir', sourcedirs[0])
+  if os.path.normpath(sourcedir) not in [os.path.normpath(served)
+                                         for served in sourcedirs]:
+    raise QueryError(403, "%s is not served" % sourcedir)
+  format = params.get('format', format)
+  if format not in output_formats:
+    raise QueryError(400, "unknown format: %s" % format)
+  try:
+    session, apps = sessions.get(sourcedir)
+  except IOError:
+    raise QueryError(404, "no packages.xml file found in %s" % sourcedir)
+  out = StringIO()
+  p = LogStats(sourcedir, 'verbose' in params, 'quiet' in params, '', '', '',
+               params.get('grep', ''), out=out, format=format)
+  p.session = session
+
+  if path == '/apps':
+    p.print_apps_list()
+  elif path == '/samples':
+    pid, uid, app = params.get('pid'), params.get('uid'), params.get('app')
+    if pid:
+      if pid not in session.pids:
+        raise QueryError(404, "PID: %s not found in AppScope log files" % pid)
+    elif uid or app:
+      if app:
+        uid = dict((name, uid) for uid, name in apps.iteritems()).get(app)
+        if uid is None:
+          raise QueryError(404, "App package name: %s not found in AppScope log files" % app)
+      elif uid not in apps:
+        raise QueryError(404, "UID: %s not found in AppScope log files" % uid)
+    else:
+      raise QueryError(400, "a pid, uid or app is required")
+
+    try:
+      first, last = [int(params[key]) if key in params else None
+                     for key in ('from', 'to')]
+    except ValueError:
+      raise QueryError(400, "from and to must be seconds")
+    try:
+      size = _parse_bucket(params['bucket']) if 'bucket' in params else None
+    except ValueError:
+      raise QueryError(400, "bucket must be a window size, e.g. 60s, 5m or 1h")
+
+    if 'component' in params:
+      p.components = params['component'].split(',')
+      unknown = [name for name in p.components if name not in component_keys]
+      if unknown:
+        raise QueryError(400, "unknown component: %s" % ', '.join(unknown))
+    if params.get('mode') in ('power', 'usage', 'all'):
+      p.mode = params['mode']
+    columns = p._columns()
+    if len(columns) == 1:
+      raise QueryError(400, "the usage mode has no columns for the component(s): %s"
+                       % params['component'])
+    keys = [key for key, title in columns]
+    if size:
+      p.stats = session.bucket(size, pid, uid, first, last, keys)
+    else:
+      p.stats = _combine_duplicate_time_samples(
+        session.select(pid, uid, first, last, keys))
+    if not p.stats:
+      p.stats = dict((key, ()) for key in keys)
+    p.print_stats(columns)
+  else:
+    raise QueryError(404, "unknown query: %s (use /apps or /samples)" % path)
+  p.flush_output()
+  return out.getvalue()
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """
+    QueryHandler (class)
+
+    Answers the HTTP GET requests of the query server (see _query)
+  """
+
+  def do_GET(self):
+    url = urlparse.urlsplit(self.path)
+    params = dict((key, values[-1])
+                  for key, values in urlparse.parse_qs(url.query, True).iteritems())
+    try:
+      body, status = _query(self.server.sessions, url.path, params,
+                            self.server.sourcedirs, self.server.format), 200
+    except QueryError, e:
+      body, status = "%s\n" % e, e.status
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/plain; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+def serve (address, sessions, sourcedirs, format):
+  """
+    serve (address, sessions, sourcedirs, format)
+
+    arguments:
+    address              -- the (host, port) to listen to
+    sessions             -- the SessionCache of the loaded sessions
+    sourcedirs           -- the source directories that can be queried
+                            (the first one by the queries without one)
+    format               -- the output format of the queries without one
+
+    answer the queries about the sessions over HTTP until interrupted
+
+  """
+  server = BaseHTTPServer.HTTPServer(address, QueryHandler)
+  server.sessions = sessions
+  server.sourcedirs = sourcedirs
+  server.format = format
+  sys.stderr.write("serving queries on http://%s:%d/\n" % server.server_address)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
 
 
 class MyParser(OptionParser):
@@ -569,13 +3639,23 @@ information
 Author: %s (http://www.thanasispetsas.com)
 """ % (_bold("appscope-analyzer"), _bold("Thanasis Petsas"))
 
-    usage = "Usage: %prog [-f FILENAME] [-t DIR] [-u UID] [-p PID] [options]"
+    usage = "Usage: %prog [-s DIR] [-o FILE] [-u UID] [-p PID] [options]"
     parser = MyParser(usage=usage, description=description)
 
     actions = OptionGroup(parser, "Actions")
     actions.add_option("-l", "--list",
                        action="store_true", dest='list', default=False,
                        help="list all the package names, UIDs and PIDs of the monitored apps")
+    actions.add_option("-r", "--report",
+                       action="store_true", dest='report', default=False,
+                       help="report the energy consumed by all the monitored apps, in a single pass")
+    actions.add_option("-S", "--summary",
+                       action="store_true", dest='summary', default=False,
+                       help="summarize the energy of every monitored app (or of the selected PID/UID/APP): totals per component, mean, peak and 50th/95th/99th percentiles of the power")
+    actions.add_option("-x", "--export", dest="export", default="",
+                       help="export all the samples of the session to a Parquet or Arrow IPC file (requires pyarrow)", metavar="FILE")
+    actions.add_option("--serve", dest="serve", default="",
+                       help="keep the sessions in memory and answer queries about them over HTTP on [HOST:]PORT (by default on localhost), e.g. GET /samples?dir=DIR&uid=UID&from=SEC&to=SEC&component=cpu,total, DIR being one of the source directories (-s)", metavar="PORT")
     actions.add_option("-a", "--app", dest="app", default="",
                        help="select this app package name to show the results", metavar="APP")
     actions.add_option("-u", "--uid", dest="uid", default="",
@@ -585,25 +3665,59 @@ Author: %s (http://www.thanasispetsas.com)
     parser.add_option_group(actions)
 
     config = OptionGroup(parser, "Configuration Options")
-    config.add_option("-s", "--source-dir", dest="sourcedir", default="./",
-                      help="the directory containing the packages.xml file", metavar="DIR")
-    # TODO: add option for storing the output to a file
-    # config.add_option("-f", "--filename", dest="filename", default="appscope.dat",
-    #                  help="the filename to store the results", metavar="FILENAME")
+    config.add_option("-s", "--source-dir", dest="sourcedir", action="append", default=None,
+                      help="the directory containing the packages.xml file, or a tar (.tar, .tar.gz, .tar.bz2, .tar.zst) or zip archive of it, read without being extracted. It can be a glob pattern and given several times, to report (-r) on many device captures at once", metavar="DIR")
+    config.add_option("-n", "--no-cache",
+                      action="store_false", dest="use_cache", default=True,
+                      help="do not read or write the parsed logs cache (%s) in DIR" % cache_filename)
+    config.add_option("-e", "--engine", dest="engine", default="auto",
+                      type="choice", choices=["auto", "python", "numpy"],
+                      help="the engine used to combine the samples: 'python', 'numpy' (vectorized, requires NumPy) or 'auto' to use NumPy when it is installed", metavar="ENGINE")
+    config.add_option("-j", "--jobs", dest="jobs", default=None, type="int",
+                      help="parse the log files with N processes. With several source directories, analyze N devices at a time (by default as many as the CPUs)", metavar="N")
+    config.add_option("--from", dest="first", default=None, type="int",
+                      help="skip the log files before second SEC", metavar="SEC")
+    config.add_option("--to", dest="last", default=None, type="int",
+                      help="skip the log files after second SEC", metavar="SEC")
+    config.add_option("--max-sessions", dest="max_sessions", default=4, type="int",
+                      help="keep at most N sessions in memory when serving queries (the least recently used ones are dropped)", metavar="N")
+    config.add_option("-o", "--output", dest="output", default="",
+                      help="write the results to FILE instead of the standard output", metavar="FILE")
     parser.add_option_group(config)
 
     output = OptionGroup(parser, "Output Options")
     output.add_option("-g", "--grep", dest="grep", default='',
                       help="print only tasks that contain WORD", metavar="WORD")
-    # TODO: add option for choosing the statistics output for showing either usage or power results etc.
-    # output.add_option("-m", "--mode", dest="mode", default="power",
-    #                   help="determine mode: 'power' for power statistics output, 'usage' for usage statistics output, 'all' for both. By default 'power' mode is used", metavar="MODE")
-    # TODO: add option to selecte the level of the output: per-process or per-app output
-    # output.add_option("-L", "--level", dest="level", default="per-app",
-    #                   help="determine level: 'per-proc' for per process output, 'per-app' for per application output. By defailr 'per-app' mode is used", metavar="LEVEL")
-    # TODO: add option to produce power statistics only for a specific component (e.g. CPU)
-    # output.add_option("-c", "--component", dest="component", default='all',
-    #                  help="print power results only for a specific component", metavar="COMP")
+    output.add_option("-F", "--format", dest="format", default="text",
+                      type="choice", choices=output_formats,
+                      help="the output format: %s. By default 'text' is used" % ', '.join(output_formats), metavar="FORMAT")
+    output.add_option("--bucket", dest="bucket", default="",
+                      help="sum up the samples in windows of SIZE (e.g. 60s, 5m or 1h) instead of printing one row per second", metavar="SIZE")
+    output.add_option("-W", "--fixed-width",
+                      action="store_true", dest="fixed_width", default=False,
+                      help="use fixed column widths, printing each line as soon as it is formatted (implied by --stream)")
+    output.add_option("--export-format", dest="export_format", default=None,
+                      type="choice", choices=["parquet", "arrow"],
+                      help="the format of the exported session: 'parquet' or 'arrow'. By default it is chosen from the extension of FILE ('.arrow' for Arrow IPC)", metavar="FORMAT")
+    output.add_option("--stream",
+                      action="store_true", dest="stream", default=False,
+                      help="print the results while the logs are parsed, using fixed column widths and bounded memory")
+    output.add_option("-f", "--follow",
+                      action="store_true", dest="follow", default=False,
+                      help="follow a session that is still being recorded, printing the results of every new second as soon as the next one starts (implies --stream). Starts from the last complete second, or from --from SEC")
+    output.add_option("-m", "--mode", dest="mode", default=None,
+                      type="choice", choices=["power", "usage", "all"],
+                      help="determine mode: 'power' for power statistics output, 'usage' for usage statistics output, 'all' for both. By default 'power' mode is used ('all' with -v)", metavar="MODE")
+    output.add_option("-L", "--level", dest="level", default="per-app",
+                      type="choice", choices=["per-app", "per-proc"],
+                      help="determine level: 'per-proc' for per process output, 'per-app' for per application output. By default 'per-app' mode is used. With 'per-proc', -r reports the energy of every process, thread group, app and shared user", metavar="LEVEL")
+    output.add_option("-c", "--component", dest="component", default='all',
+                      help="print results only for these components (comma separated): %s or 'all'. The values of the other components are not parsed" % ', '.join(component_keys), metavar="COMP")
+    output.add_option("--timings",
+                      action="store_true", dest="timings", default=False,
+                      help="report the time spent in each phase of the run and the I/O counters to the standard error")
+    output.add_option("--profile", dest="profile", default="",
+                      help="profile the run with cProfile and save the stats to FILE", metavar="FILE")
     output.add_option("-v", "--verbose",
                       action="store_true", dest="verbose", default=False,
                       help="print more detailed output to the screen")
@@ -614,23 +3728,131 @@ Author: %s (http://www.thanasispetsas.com)
 
     return parser
 
-def main():
-  """Run the command-line interface."""
-  parser = _build_parser()
-  (options, args) = parser.parse_args()
-
-  p = LogStats(sourcedir=options.sourcedir, verbose=options.verbose,
-                   quiet=options.quiet, pid=options.pid, uid=options.uid,
-                   app=options.app, grep=options.grep)
-  if options.list:
+def _run(p, options, parser, sourcedirs):
+  """Run the action selected in the command-line options."""
+  if options.serve:
+    # answer queries until interrupted
+    host, sep, port = options.serve.rpartition(':')
+    serve((host or 'localhost', int(port)),
+          SessionCache(options.max_sessions, options.use_cache, options.jobs or 1),
+          sourcedirs, options.format)
+  elif options.list:
     # list all the monitored apps
     p.print_apps_list()
+  elif options.export:
+    # export the parsed session
+    format = options.export_format
+    if not format:
+      format = options.export.endswith('.arrow') and 'arrow' or 'parquet'
+    p.export_session(options.export, format)
+  elif options.report and len(sourcedirs) > 1:
+    # report the energy of the monitored apps of every device
+    import multiprocessing
+    p.print_devices_report(sourcedirs, options.jobs or multiprocessing.cpu_count())
+  elif options.report:
+    # report the energy of all the monitored apps
+    p.print_apps_report()
+  elif options.summary:
+    # summarize the energy of the monitored apps
+    p.print_summary()
+  elif (options.pid or options.uid or options.app) and (options.stream or options.follow):
+    # stream the results for the selected PID/UID
+    p.print_stream()
   elif options.pid or options.uid or options.app:
     # show results for the selected UID
     p.print_results()
   else:
     parser.print_help()
 
+def main():
+  """Run the command-line interface."""
+  parser = _build_parser()
+  (options, args) = parser.parse_args()
+
+  if options.engine == 'numpy' and not numpy:
+    parser.error("the numpy engine requires NumPy to be installed")
+
+  if options.export:
+    try:
+      import pyarrow
+    except ImportError:
+      parser.error("exporting sessions requires pyarrow to be installed")
+
+  if options.serve and not options.serve.rpartition(':')[2].isdigit():
+    parser.error("the server address must be [HOST:]PORT")
+  if options.max_sessions < 1:
+    parser.error("at least one session must be kept in memory")
+
+  components = None
+  if options.component != 'all':
+    components = options.component.split(',')
+    unknown = [name for name in components if name not in component_keys]
+    if unknown:
+      parser.error("unknown component: %s" % ', '.join(unknown))
+    if options.mode == 'usage' and \
+       len(_select_columns(output_columns['usage'], components)) == 1:
+      parser.error("the usage mode has no columns for the component(s): %s"
+                   % options.component)
+
+  bucket = None
+  if options.bucket:
+    try:
+      bucket = _parse_bucket(options.bucket)
+    except ValueError:
+      parser.error("the window size must be a number of seconds, e.g. 60s, 5m or 1h")
+    if options.level == 'per-proc' and (options.stream or options.follow):
+      parser.error("--bucket cannot be used with -L per-proc when streaming")
+
+  sourcedirs = _expand_sourcedirs(options.sourcedir or ["./"])
+  if len(sourcedirs) > 1 and not options.serve and \
+     (options.list or options.export or not options.report):
+    parser.error("several source directories can only be analyzed with -r or served")
+  if len(sourcedirs) > 1:
+    for sourcedir in sourcedirs:
+      if not (_is_archive(sourcedir) or
+              os.path.isfile(os.path.join(sourcedir, "packages.xml"))):
+        parser.error("no packages.xml file found in %s" % sourcedir)
+  if options.follow and _is_archive(sourcedirs[0]):
+    parser.error("an archive cannot be followed (-f)")
+  if not zstandard and [s for s in sourcedirs if s.endswith(('.zst', '.tzst'))]:
+    parser.error("reading zstd archives requires zstandard to be installed")
+
+  out = sys.stdout
+  if options.output:
+    try:
+      out = open(options.output, 'w')
+    except IOError, e:
+      parser.error("cannot write to %s: %s" % (options.output, e.strerror))
+
+  p = LogStats(sourcedir=sourcedirs[0], verbose=options.verbose,
+                   quiet=options.quiet, pid=options.pid, uid=options.uid,
+                   app=options.app, grep=options.grep,
+                   use_cache=options.use_cache, stream=options.stream,
+                   engine=options.engine, jobs=options.jobs or 1,
+                   first=options.first, last=options.last,
+                   out=out, format=options.format,
+                   fixed_width=options.fixed_width, follow=options.follow,
+                   mode=options.mode, components=components,
+                   level=options.level, bucket=bucket)
+  try:
+    if options.profile:
+      import cProfile, pstats
+      profiler = cProfile.Profile()
+      try:
+        profiler.runcall(_run, p, options, parser, sourcedirs)
+      finally:
+        profiler.dump_stats(options.profile)
+        pstats.Stats(options.profile, stream=sys.stderr).sort_stats('cumulative').print_stats(15)
+    else:
+      _run(p, options, parser, sourcedirs)
+  finally:
+    p.flush_output()
+    if out is not sys.stdout:
+      out.close()
+    parse_errors.report()
+    if options.timings:
+      timings.report()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+ bench.py times appscope-analyzer against synthetic AppScope sessions
+ (see gen_trace.py) of several sizes, and records the wall time and the
+ peak memory (RSS) of each run:
+
+   -l          list the monitored apps
+   -p PID      the samples of a process
+   -u UID      the samples of an app
+   -r          the report of all the apps (whole session)
+
+ each one without the cache (cold, -n) and with it (warm). The results
+ can be saved to a CSV file, and compared to a previous one to spot
+ regressions before a release.
+
+ With -P, the log line parsers are timed instead, on the lines of the
+ sessions already read in memory.
+
+"""
+
+from __future__ import with_statement
+
+import os, sys, time, csv, shutil, tempfile, imp
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gen_trace
+
+asa_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'appscope-analyzer.py')
+
+# name -> (seconds, pids, uids)
+scales = {'tiny': (60, 20, 8),
+          'small': (300, 50, 20),
+          'medium': (1800, 150, 60),
+          'large': (7200, 300, 100)}
+
+# a slower run than the reference one by more than this is a regression
+regression_ratio = 1.2
+
+
+def _run (args):
+  """
+    _run (args)
+
+    arguments:
+    args                 -- the arguments of appscope-analyzer
+
+    run appscope-analyzer, discarding its output, and return its
+    wall time (in seconds) and peak RSS (in KB)
+
+  """
+  with open(os.devnull, 'w') as devnull:
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+      os.dup2(devnull.fileno(), 1)
+      try:
+        os.execv(sys.executable, [sys.executable, asa_path] + args)
+      finally:
+        os._exit(127)
+    pid, status, rusage = os.wait4(pid, 0)
+    wall = time.time() - start
+  if status:
+    raise RuntimeError("appscope-analyzer %s failed (status %d)" % (' '.join(args), status))
+  return wall, rusage.ru_maxrss
+
+def bench_session (sourcedir, processes, repeat=3):
+  """
+    bench_session (sourcedir, processes, repeat)
+
+    arguments:
+    sourcedir            -- the directory of the session
+    processes            -- its (PID, TGID, UID) tuples
+    repeat               -- the number of runs of each query (the
+                            fastest one is kept)
+
+    returns a list of (query, cache, wall time, peak RSS) tuples
+
+  """
+  # an app process in the middle of the list
+  pid, tgid, uid = [process for process in processes if process[2]][len(processes) // 2]
+  queries = [('list', ['-l']),
+             ('pid', ['-p', str(pid)]),
+             ('uid', ['-u', str(uid)]),
+             ('report', ['-r'])]
+  results = []
+  for name, args in queries:
+    args = ['-s', sourcedir] + args
+    cold = min(_run(args + ['-n']) for i in range(repeat))
+    # the first run builds the cache
+    _run(args)
+    warm = min(_run(args) for i in range(repeat))
+    results.append((name, 'cold', cold[0], cold[1]))
+    results.append((name, 'warm', warm[0], warm[1]))
+  return results
+
+def _split_parse (second, raw_lines, power_lines):
+  # the line parser of the first releases (for reference): each usage
+  # line is split three times (the first split being discarded) and
+  # paired with the power line at the same position
+  for r_line, p_line in zip(raw_lines, power_lines):
+    r_line = r_line.strip()
+    raw_values = r_line.split(" ", 11)
+    del raw_values[-1]
+    PID, TGID, UID, CPU_TICKS_REST = r_line.split(" ", 3)
+    cpu_ticks_freq = CPU_TICKS_REST.split(" ", 12)
+    REST = cpu_ticks_freq.pop()
+    disp, gps, wifi_snd_pkts, wifi_rcv_pkts, g3_low,\
+    g3_high, calling = REST.split()
+    values = [float(value.strip()) for value in p_line.strip().split()]
+    CPU_en, DISP_en, GPS_en, WIFI_en, G3_en = values
+    total_en = CPU_en + DISP_en + GPS_en + WIFI_en + G3_en
+    yield PID, TGID, UID, (second, int(PID), int(TGID), int(UID),
+                           map(int, cpu_ticks_freq), int(disp), int(gps),
+                           int(wifi_snd_pkts), int(wifi_rcv_pkts), int(g3_low),
+                           int(g3_high), int(calling), CPU_en, DISP_en, GPS_en,
+                           WIFI_en, G3_en, total_en)
+
+def bench_parser (sourcedir, repeat=3):
+  """
+    bench_parser (sourcedir, repeat)
+
+    arguments:
+    sourcedir            -- the directory of the session
+    repeat               -- the number of runs of each parser (the
+                            fastest one is kept)
+
+    time the parsing of all the log lines of a session, read in memory
+    beforehand: the triple split of the first releases, the tokenized
+    parser of appscope-analyzer and the line by line one it falls back
+    to on malformed lines. returns a list of (parser, lines, wall time)
+    tuples
+
+  """
+  asa = imp.load_source('appscope_analyzer', asa_path)
+  seconds = [(second,) + asa._read_second(raw_fn, power_fn)
+             for second, raw_fn, power_fn in asa._list_seconds(sourcedir)]
+  lines = sum(len(raw_lines) for second, raw_lines, power_lines in seconds)
+  parsers = [('split', _split_parse),
+             ('tokenized', asa._parse_second),
+             ('per-line', lambda second, raw_lines, power_lines:
+                asa._parse_lines(second, raw_lines, power_lines, keys=asa.stats_keys))]
+  results = []
+  for name, parse in parsers:
+    walls = []
+    for i in range(repeat):
+      start = time.time()
+      for second, raw_lines, power_lines in seconds:
+        for sample in parse(second, raw_lines, power_lines):
+          pass
+      walls.append(time.time() - start)
+    results.append((name, lines, min(walls)))
+  return results
+
+def _load_reference (path):
+  with open(path) as f:
+    return dict(((row['scale'], row['query'], row['cache']), float(row['wall']))
+                for row in csv.DictReader(f))
+
+
+def main():
+  usage = "Usage: %prog [-S SCALE[,SCALE...]] [-r N] [-o FILE] [-c FILE]"
+  parser = OptionParser(usage=usage, description="benchmark appscope-analyzer on synthetic sessions")
+  parser.add_option("-S", "--scales", dest="scales", default="small,medium",
+                    help="comma separated scales to run: %s (default: small,medium)" %
+                    ', '.join(sorted(scales)), metavar="SCALES")
+  parser.add_option("-r", "--repeat", dest="repeat", default=3, type="int",
+                    help="the number of runs of each query (default: 3)", metavar="N")
+  parser.add_option("-P", "--parser", dest="parser", action="store_true", default=False,
+                    help="time the log line parsers instead of the queries")
+  parser.add_option("-w", "--work-dir", dest="workdir", default="",
+                    help="keep the generated sessions in DIR (reused if present)", metavar="DIR")
+  parser.add_option("-o", "--output", dest="output", default="",
+                    help="save the results to a CSV file", metavar="FILE")
+  parser.add_option("-c", "--compare", dest="compare", default="",
+                    help="compare the results with a previously saved CSV file", metavar="FILE")
+  (options, args) = parser.parse_args()
+
+  names = options.scales.split(',')
+  for name in names:
+    if name not in scales:
+      parser.error("unknown scale: %s" % name)
+  reference = options.compare and _load_reference(options.compare) or {}
+
+  workdir = options.workdir or tempfile.mkdtemp(prefix='asa-bench-')
+  rows = []
+  regressions = 0
+  if options.parser:
+    try:
+      print "%-8s %-10s %10s %10s %12s %8s" % ('SCALE', 'PARSER', 'LINES', 'WALL (S)', 'LINES/S', 'SPEEDUP')
+      for name in names:
+        seconds, pids, uids = scales[name]
+        sourcedir = os.path.join(workdir, name)
+        if not os.path.exists(os.path.join(sourcedir, 'packages.xml')):
+          gen_trace.generate(sourcedir, seconds, pids, uids)
+        results = bench_parser(sourcedir, options.repeat)
+        split_wall = results[0][2]
+        for parser_name, lines, wall in results:
+          print "%-8s %-10s %10d %10.3f %12d %7.2fx" % (name, parser_name, lines, wall,
+                                                        lines / wall, split_wall / wall)
+          sys.stdout.flush()
+    finally:
+      if not options.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return
+
+  try:
+    print "%-8s %-8s %-6s %10s %10s" % ('SCALE', 'QUERY', 'CACHE', 'WALL (S)', 'RSS (KB)')
+    for name in names:
+      seconds, pids, uids = scales[name]
+      sourcedir = os.path.join(workdir, name)
+      if os.path.exists(os.path.join(sourcedir, 'packages.xml')):
+        processes = gen_trace._processes(pids, uids)
+      else:
+        processes = gen_trace.generate(sourcedir, seconds, pids, uids)
+      for query, cache, wall, rss in bench_session(sourcedir, processes, options.repeat):
+        line = "%-8s %-8s %-6s %10.3f %10d" % (name, query, cache, wall, rss)
+        ref = reference.get((name, query, cache))
+        if ref:
+          line += "   (%+.0f%%)" % ((wall / ref - 1) * 100)
+          if wall > ref * regression_ratio:
+            line += " REGRESSION"
+            regressions += 1
+        print line
+        sys.stdout.flush()
+        rows.append({'scale': name, 'query': query, 'cache': cache,
+                     'wall': "%.4f" % wall, 'rss': rss})
+  finally:
+    if not options.workdir:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  if options.output:
+    with open(options.output, 'wb') as f:
+      writer = csv.DictWriter(f, ['scale', 'query', 'cache', 'wall', 'rss'])
+      writer.writeheader()
+      writer.writerows(rows)
+  if regressions:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+ gen_trace.py generates synthetic AppScope sessions, laid out exactly
+ like the ones recorded on the devices:
+
+   DIR/packages.xml
+   DIR/<second>/raw/<second>         (usage log, one line per process)
+   DIR/<second>/power/<second>.log   (power log, one line per process)
+
+ so that appscope-analyzer can be measured against sessions of any
+ length and number of processes and apps.
+
+"""
+
+from __future__ import with_statement
+
+import os, sys, random
+from optparse import OptionParser
+
+# number of the CPU frequencies the ticks are reported for
+cpu_freqs = 12
+
+raw_header = "PID TGID UID CPU_TICKS(%d) DISP GPS WIFI_SND WIFI_RCV 3G_LOW 3G_HIGH CALLING" % cpu_freqs
+
+
+def _processes (pids, uids):
+  """
+    _processes (pids, uids)
+
+    arguments:
+    pids                 -- the number of processes
+    uids                 -- the number of apps (UIDs)
+
+    returns a list of (PID, TGID, UID) tuples. One process out of
+    ten is a system (UID 0) process and one out of four is a thread
+    of the previous process (same TGID)
+
+  """
+  processes = []
+  for i in range(pids):
+    pid = 300 + i
+    if i % 10 == 0:
+      uid = 0
+    else:
+      uid = 10000 + i % uids
+    tgid = pid
+    if i % 4 == 3:
+      # a thread of the previous process
+      tgid, uid = processes[-1][1], processes[-1][2]
+    processes.append((pid, tgid, uid))
+  return processes
+
+def write_packages_xml (path, uids):
+  """
+    write_packages_xml (path, uids)
+
+    write a packages.xml file with a package for each app UID. One
+    package out of five declares its UID with sharedUserId
+
+  """
+  with open(path, 'w') as f:
+    f.write("<?xml version='1.0' encoding='utf-8' standalone='yes' ?>\n<packages>\n")
+    for i in range(uids):
+      attribute = 'userId'
+      if i % 5 == 4:
+        attribute = 'sharedUserId'
+      f.write('<package name="com.example.app%d" codePath="/data/app/com.example.app%d-1.apk" '
+              '%s="%d">\n<perms>\n<item name="android.permission.INTERNET" />\n</perms>\n'
+              '</package>\n' % (i, i, attribute, 10000 + i))
+    f.write("</packages>\n")
+
+def write_second (sourcedir, second, processes, rand, presence=0.9):
+  """
+    write_second (sourcedir, second, processes, rand, presence)
+
+    write the usage (raw) and power logs of a second. Each process
+    is active in the second with the given probability
+
+  """
+  raw_dir = os.path.join(sourcedir, str(second), 'raw')
+  power_dir = os.path.join(sourcedir, str(second), 'power')
+  os.makedirs(raw_dir)
+  os.makedirs(power_dir)
+  raw_lines = [raw_header]
+  power_lines = []
+  totals = [0.0] * 5
+  for pid, tgid, uid in processes:
+    if rand.random() > presence:
+      continue
+    ticks = ' '.join(str(rand.randint(0, 60)) for i in range(cpu_freqs))
+    raw_lines.append("%d %d %d %s %d %d %d %d %d %d %d" % (pid, tgid, uid, ticks,
+                     rand.randint(0, 1000000), rand.randint(0, 1) * rand.randint(0, 1000000),
+                     rand.randint(0, 40), rand.randint(0, 40), rand.randint(0, 5),
+                     rand.randint(0, 2), 0))
+    energies = [rand.random() * 600, rand.random() * 400, rand.random() * 50,
+                rand.random() * 200, rand.random() * 300]
+    totals = [total + energy for total, energy in zip(totals, energies)]
+    power_lines.append(' '.join("%.4f" % energy for energy in energies))
+  # the power log ends with the totals of the second
+  power_lines.append(' '.join("%.4f" % total for total in totals))
+  with open(os.path.join(raw_dir, str(second)), 'w') as f:
+    f.write('\n'.join(raw_lines) + '\n')
+  with open(os.path.join(power_dir, '%d.log' % second), 'w') as f:
+    f.write('\n'.join(power_lines) + '\n')
+
+def generate (sourcedir, seconds, pids, uids, seed=0, first=1):
+  """
+    generate (sourcedir, seconds, pids, uids, seed, first)
+
+    arguments:
+    sourcedir            -- the directory of the session (created)
+    seconds              -- the length of the session in seconds
+    pids                 -- the number of processes
+    uids                 -- the number of apps (UIDs)
+    seed                 -- the seed of the random values
+    first                -- the first second of the session
+
+    generate a synthetic AppScope session and return its processes
+
+  """
+  rand = random.Random(seed)
+  if not os.path.isdir(sourcedir):
+    os.makedirs(sourcedir)
+  write_packages_xml(os.path.join(sourcedir, 'packages.xml'), uids)
+  processes = _processes(pids, uids)
+  for second in range(first, first + seconds):
+    write_second(sourcedir, second, processes, rand)
+  return processes
+
+
+def main():
+  usage = "Usage: %prog -o DIR [-S SECONDS] [-P PIDS] [-U UIDS] [--seed N]"
+  parser = OptionParser(usage=usage, description="generate a synthetic AppScope session")
+  parser.add_option("-o", "--output-dir", dest="sourcedir", default="",
+                    help="the directory to write the session to", metavar="DIR")
+  parser.add_option("-S", "--seconds", dest="seconds", default=600, type="int",
+                    help="the length of the session in seconds (default: 600)", metavar="SECONDS")
+  parser.add_option("-P", "--pids", dest="pids", default=100, type="int",
+                    help="the number of processes (default: 100)", metavar="PIDS")
+  parser.add_option("-U", "--uids", dest="uids", default=40, type="int",
+                    help="the number of apps (default: 40)", metavar="UIDS")
+  parser.add_option("--seed", dest="seed", default=0, type="int",
+                    help="the seed of the random values (default: 0)", metavar="N")
+  (options, args) = parser.parse_args()
+  if not options.sourcedir:
+    parser.error("the output directory is required")
+  if os.path.exists(os.path.join(options.sourcedir, 'packages.xml')):
+    parser.error("%s already contains a session" % options.sourcedir)
+  generate(options.sourcedir, options.seconds, options.pids, options.uids, options.seed)
+
+
+if __name__ == '__main__':
+  main()